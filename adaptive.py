@@ -0,0 +1,78 @@
+import fcntl
+import http.client
+import json
+import os
+import urllib.error
+
+MIN_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000000
+GROWTH = 1.5
+SHRINK = 0.5
+
+
+def retryable(error):
+    # Timeouts, dropped connections and 5xx responses are treated as the endpoint struggling with the page size.
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code >= 500
+    return isinstance(error, (urllib.error.URLError, http.client.HTTPException, OSError))
+
+
+def load_sizes(path):
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_size(path, key, size):
+    if not path:
+        return
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        sizes = load_sizes(path)
+        sizes[key] = size
+        temporaryPath = path + "." + str(os.getpid()) + ".tmp"
+        with open(temporaryPath, "w") as file:
+            json.dump(sizes, file, indent=2, sort_keys=True)
+        os.replace(temporaryPath, path)
+
+
+def learned_size(context, key):
+    if not context.adaptive:
+        return context.batch_size
+    return load_sizes(context.batch_state).get(key, context.batch_size)
+
+
+class PageSizer:
+    # Chooses the page size of one (DataType, field). Pages grow while they come back well within
+    # --page-seconds, shrink when they take much longer, and are halved and retried after timeouts or 5xx
+    # responses. The last size is stored in --batch-state so the next run starts from it.
+    def __init__(self, context, key):
+        self.context = context
+        self.key = key
+        self.size = learned_size(context, key)
+
+    def observe(self, seconds):
+        if not self.context.adaptive:
+            return
+        if seconds < self.context.page_seconds / 2:
+            self.size = min(int(self.size * GROWTH), MAX_PAGE_SIZE)
+        elif seconds > self.context.page_seconds * 2:
+            self.size = max(int(self.size * SHRINK), MIN_PAGE_SIZE)
+
+    def shrink(self):
+        if not self.context.adaptive or self.size <= MIN_PAGE_SIZE:
+            return False
+        self.size = max(int(self.size * SHRINK), MIN_PAGE_SIZE)
+        return True
+
+    def grow(self):
+        if not self.context.adaptive or self.size >= MAX_PAGE_SIZE:
+            return False
+        self.size = min(self.size * 2, MAX_PAGE_SIZE)
+        return True
+
+    def save(self):
+        if self.context.adaptive:
+            save_size(self.context.batch_state, self.key, self.size)
+
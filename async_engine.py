@@ -0,0 +1,164 @@
+import asyncio
+import time
+
+from pymongo import UpdateOne
+
+from adaptive import PageSizer
+from query_generators import generate_count_query, generate_keyset_query, generateUrl
+from scheduler import data_type_key, timestamp
+from updaters import TsvRows, shadow_suffix
+from writer import BulkWriter
+
+try:
+    import aiohttp
+    from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:
+    aiohttp = None
+    AsyncIOMotorClient = None
+
+
+class AsyncBulkWriter(BulkWriter):
+    # Collects full flushes from the synchronous handlers; drain() writes them through Motor.
+    def __init__(self, flush_size, name, suffix):
+        super().__init__(None, flush_size, name, False, suffix)
+        self.ready = []
+
+    def flush_collection(self, name):
+        pending = self.pending.pop(name, None)
+        if pending:
+            self.ready.append((name, pending))
+
+    async def drain(self, mdb, mongoSlots):
+        ready = self.ready
+        self.ready = []
+        for name, pending in ready:
+            operations = [UpdateOne({"_id": id}, update, upsert=True) for id, update in pending.items()]
+            async with mongoSlots:
+                startTime = time.time()
+                await mdb[name].bulk_write(operations, ordered=False)
+                self.writeTime += time.time() - startTime
+            self.written += len(operations)
+
+
+class AsyncEngine:
+    # Runs every (DataType, field) as a coroutine in one process. All downloads share one aiohttp session and
+    # all writes one Motor connection pool, with separate limits for the endpoint and for MongoDB.
+    def __init__(self, context):
+        self.context = context
+        self.sparqlSlots = asyncio.Semaphore(context.sparql_connections or context.workers)
+        self.mongoSlots = asyncio.Semaphore(context.mongo_connections or context.workers)
+        self.session = None
+        self.mdb = None
+
+    async def fetch_rows(self, url):
+        rows = TsvRows()
+        async with self.sparqlSlots:
+            async with self.session.get(url) as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(1 << 20):
+                    yield list(rows.feed(chunk))
+        yield list(rows.finish())
+
+    async def count(self, query):
+        url = generateUrl(self.context.baseUrl, generate_count_query(query))
+        result = []
+        async for rows in self.fetch_rows(url):
+            result.extend(rows)
+        if result:
+            return int(result[0][0])
+        return 0
+
+    async def run_field(self, dataType, target):
+        context = self.context
+        name, query, handler_function = target(dataType, context, describe=True)
+        startTime = time.time()
+        count = await self.count(query)
+        print(timestamp() + "Found " + str(count) + " " + name + " in " + dataType.graph)
+        writer = AsyncBulkWriter(context.flush_size, name, shadow_suffix if context.rebuild else "")
+        sizer = PageSizer(context, data_type_key(dataType) + "/" + name)
+        after = None
+        attempts = 0
+        counter = 0
+        while count:
+            pageStart = time.time()
+            pageSize = sizer.size
+            url = generateUrl(context.baseUrl, generate_keyset_query(query, after, pageSize))
+            pageRows = 0
+            previousUri = None
+            currentUri = None
+            currentRows = []
+            pageCounter = 0
+            try:
+                async for rows in self.fetch_rows(url):
+                    for row in rows:
+                        pageRows += 1
+                        if row[0] != currentUri:
+                            for heldRow in currentRows:
+                                handler_function(writer, dataType, heldRow)
+                            pageCounter += len(currentRows)
+                            previousUri = currentUri
+                            currentUri = row[0]
+                            currentRows = []
+                        currentRows.append(row)
+                    await writer.drain(self.mdb, self.mongoSlots)
+                lastPage = pageRows < pageSize
+                if lastPage:
+                    for heldRow in currentRows:
+                        handler_function(writer, dataType, heldRow)
+                    pageCounter += len(currentRows)
+                elif previousUri is None:
+                    if sizer.grow():
+                        continue
+                    raise Exception("A single uri has more than " + str(pageSize) + " rows. Increase --batchsize.")
+                writer.flush()
+                await writer.drain(self.mdb, self.mongoSlots)
+            except Exception as error:
+                attempts += 1
+                writer.pending = {}
+                writer.ready = []
+                print(timestamp() + dataType.graph + " " + name + " failed after " + str(after) + " (attempt " +
+                      str(attempts) + "): " + repr(error))
+                if attempts > context.retries:
+                    sizer.save()
+                    raise
+                if not sizer.shrink():
+                    await asyncio.sleep(min(2 ** attempts, 60))
+                continue
+            attempts = 0
+            sizer.observe(time.time() - pageStart)
+            counter += pageCounter
+            print(timestamp() + dataType.graph + " updated " + name + " line " + str(counter) + "/" + str(count))
+            if lastPage:
+                break
+            after = previousUri
+        sizer.save()
+
+        durationTime = time.time() - startTime
+        print(timestamp() + "Updated " + str(counter) + " " + dataType.graph + " " + name + " in " +
+              time.strftime("%H:%M:%S.", time.gmtime(durationTime)) + ", " + str(int(writer.rate())) + " docs/s")
+
+    async def run(self, tasks):
+        connector = aiohttp.TCPConnector(limit=self.context.sparql_connections or self.context.workers)
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=self.context.timeout or None)
+        client = AsyncIOMotorClient(self.context.mongo_uri,
+                                    maxPoolSize=self.context.mongo_connections or self.context.workers)
+        self.mdb = client[self.context.dbName]
+        failed = []
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            self.session = session
+            results = await asyncio.gather(*[self.run_field(dataType, target) for dataType, target in tasks],
+                                           return_exceptions=True)
+        client.close()
+        for (dataType, target), result in zip(tasks, results):
+            if isinstance(result, Exception):
+                print(timestamp() + "Giving up on " + dataType.graph + " " + target.__name__ + ": " + repr(result))
+                failed.append((dataType, target))
+        return failed
+
+
+def run_async(tasks, context):
+    if aiohttp is None or AsyncIOMotorClient is None:
+        raise SystemExit("The async engine requires the aiohttp and motor packages.")
+    print(timestamp() + "Running " + str(len(tasks)) + " updates as coroutines...")
+    return asyncio.run(AsyncEngine(context).run(tasks))
+
@@ -0,0 +1,113 @@
+import copy
+from types import SimpleNamespace
+
+from pymongo.errors import BulkWriteError
+
+# An in-memory stand-in for the parts of pymongo used by the updater, so the load path can be measured
+# without a mongod. It applies $set/$addToSet upserts with the same results as the server, but none of
+# the server's costs (journaling, index maintenance, network), so it measures the client side only.
+
+
+class MockCollection:
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.documents = {}
+        self.indexes = []
+
+    def apply(self, id, update):
+        document = self.documents.setdefault(id, {"_id": id})
+        for operator, fields in update.items():
+            for field, value in fields.items():
+                target = document
+                path = field.split(".")
+                for part in path[:-1]:
+                    target = target.setdefault(part, {})
+                if operator == "$set":
+                    target[path[-1]] = copy.deepcopy(value)
+                elif operator == "$addToSet":
+                    values = target.setdefault(path[-1], [])
+                    for item in value["$each"] if isinstance(value, dict) else [value]:
+                        if item not in values:
+                            values.append(item)
+
+    def bulk_write(self, operations, ordered=True):
+        for operation in operations:
+            self.apply(operation._filter["_id"], operation._doc)
+
+    def update_one(self, filter, update, upsert=False):
+        self.apply(filter["_id"], update)
+
+    def find(self, filter=None, projection=None):
+        ids = (filter or {}).get("_id", {}).get("$in")
+        documents = [self.documents[id] for id in ids if id in self.documents] if ids is not None \
+            else list(self.documents.values())
+        return MockCursor(documents)
+
+    def insert_many(self, documents, ordered=True):
+        errors = []
+        for document in documents:
+            if document["_id"] in self.documents:
+                errors.append({"code": 11000})
+            else:
+                self.documents[document["_id"]] = dict(document)
+        if errors:
+            raise BulkWriteError({"writeErrors": errors})
+
+    def delete_many(self, filter):
+        ids = filter.get("_id", {}).get("$in")
+        if ids is None:
+            ids = list(self.documents.keys())
+        deleted = [id for id in ids if self.documents.pop(id, None) is not None]
+        return SimpleNamespace(deleted_count=len(deleted))
+
+    def create_indexes(self, indexes):
+        self.indexes.extend(indexes)
+
+    def index_information(self):
+        return {index.document["name"]: index.document for index in self.indexes}
+
+    def rename(self, name, dropTarget=False):
+        self.database.collections.pop(self.name)
+        self.name = name
+        self.database.collections[name] = self
+
+
+class MockCursor(list):
+    def sort(self, key, direction=1):
+        return iter(sorted(self, key=lambda document: document[key], reverse=direction < 0))
+
+
+class MockDatabase:
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = MockCollection(self, name)
+        return self.collections[name]
+
+    def __getattr__(self, name):
+        return self[name]
+
+    def list_collection_names(self):
+        return list(self.collections.keys())
+
+    def drop_collection(self, name):
+        self.collections.pop(name, None)
+
+    def command(self, name):
+        if name == "dropDatabase":
+            self.collections = {}
+
+
+class MockMongoClient:
+    databases = {}
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getitem__(self, name):
+        if name not in self.databases:
+            self.databases[name] = MockDatabase()
+        return self.databases[name]
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from pymongo import MongoClient
+
+import updaters
+from main import DataType, DatabaseCollection, UpdateContext
+from scheduler import run_serial
+from sparql_stub import start_background_server
+from mock_mongo import MockMongoClient
+
+DB_NAME = "metadb_benchmark"
+
+field_scenarios = {
+    "labels": updaters.update_labels,
+    "synonyms": updaters.update_synonyms,
+    "scores": updaters.update_scores,
+    "taxon": updaters.update_taxon,
+    "instances": updaters.update_instances,
+    "annotationScore": updaters.update_annotationScore,
+    "combined": updaters.update_combined,
+}
+
+
+def benchmark_data_type():
+    return DataType("prot", [DatabaseCollection("prot")],
+                    "?uri rdfs:subClassOf <http://semanticscience.org/resource/SIO_010043> .", True, True, True, True, True)
+
+
+def run_field(name, target, context):
+    # Runs the jobs of one updater in this process, the way the serial mode does, and measures rows/s and peak
+    # Python memory.
+    dataType = benchmark_data_type()
+    tracemalloc.start()
+    startTime = time.perf_counter()
+    jobs = updaters.startBatches(dataType, name, target, context)
+    if run_serial(jobs, context):
+        raise RuntimeError("The " + name + " scenario failed.")
+    count = jobs[0].count if jobs else 0
+    duration = time.perf_counter() - startTime
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"scenario": name, "rows": count, "seconds": duration, "peakMB": peak / 1e6}
+
+
+def run_mode(name, port, extraArguments):
+    # Runs main.py end to end against the stub. Peak memory comes from the rusage of this run alone, which on
+    # Linux is the largest resident size of main.py or of any worker process it waited for. The rows of a
+    # mode are the prot documents it left in the database, so modes that load different data stand out.
+    command = [sys.executable, os.path.join(ROOT, "main.py"), "127.0.0.1", str(port), DB_NAME,
+               "--datatype", "prot", "--drop"] + extraArguments
+    startTime = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    duration = time.perf_counter() - startTime
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    documents = MongoClient()[DB_NAME]["prot"].count_documents({})
+    return {"scenario": name, "rows": documents, "seconds": duration, "peakMB": usage.ru_maxrss * 1024 / 1e6}
+
+
+def print_results(results):
+    print("%-28s %12s %10s %12s %10s" % ("scenario", "rows", "seconds", "rows/s", "peak MB"))
+    for result in results:
+        rate = result["rows"] / result["seconds"] if result["rows"] else 0
+        print("%-28s %12d %10.2f %12.0f %10.1f" % (result["scenario"], result["rows"], result["seconds"], rate,
+                                                   result["peakMB"]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the metadatabase updater against a local SPARQL stand-in.')
+    parser.add_argument('--entities', type=int, default=100000, help='Number of entities in each synthetic graph.')
+    parser.add_argument('--mongo', choices=['mock', 'local'], default='mock',
+                        help='Write to an in-memory mock, or to the mongod on localhost:27017.')
+    parser.add_argument('--fields', nargs='*', default=list(field_scenarios.keys()), help='Updaters to benchmark.')
+    parser.add_argument('--modes', default=False, action='store_true',
+                        help='Also run main.py serially and with --parallel (requires --mongo local).')
+    parser.add_argument('--workers', type=int, default=4, help='Workers for the --parallel scenario.')
+    parser.add_argument('--batchsize', type=int, default=50000, help='Page or batch size.')
+    parser.add_argument('--flushsize', type=int, default=1000, help='Documents per bulk write.')
+    parser.add_argument('--pagination', choices=['keyset', 'offset'], default='offset')
+    parser.add_argument('--queue-depth', type=int, default=8, dest='queue_depth')
+    parser.add_argument('--no-gzip', default=False, dest='no_gzip', action='store_true', help='Serve uncompressed responses.')
+    args = parser.parse_args()
+
+    server = start_background_server(args.entities, compress=not args.no_gzip)
+    port = server.server_address[1]
+    print("SPARQL stand-in on port %d with %d entities per graph, writing to %s MongoDB" % (port, args.entities, args.mongo))
+    if args.mongo == "mock":
+        updaters.MongoClient = MockMongoClient
+
+    context = UpdateContext("127.0.0.1:" + str(port), DB_NAME, False, args.batchsize, False, args.flushsize,
+                            pagination=args.pagination, queue_depth=args.queue_depth)
+    results = []
+    for name in args.fields:
+        results.append(run_field(name, field_scenarios[name], context))
+
+    if args.modes:
+        if args.mongo != "local":
+            print("Skipping the serial/--parallel scenarios: they run main.py in new processes and need --mongo local.")
+        else:
+            common = ["--batchsize", str(args.batchsize), "--flushsize", str(args.flushsize),
+                      "--pagination", args.pagination]
+            modes = [run_mode("main.py serial", port, common),
+                     run_mode("main.py --parallel", port, common + ["--parallel", "--workers", str(args.workers)])]
+            if modes[0]["rows"] != modes[1]["rows"]:
+                print("The serial and --parallel runs left different numbers of documents, their times do not compare.")
+            results.extend(modes)
+
+    print_results(results)
+    server.shutdown()
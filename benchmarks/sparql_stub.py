@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+import argparse
+import bisect
+import re
+import threading
+import urllib.parse
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A local stand-in for the BioGateway /sparql/ endpoint. It does not evaluate SPARQL; it recognises the
+# queries built by query_generators.py and answers them from synthetic prot/gene/omim/go graphs, honouring
+# COUNT, LIMIT/OFFSET and the keyset FILTER(STR(?uri) > "...") / ORDER BY used for paging. Responses are
+# sent with chunked transfer encoding on keep-alive connections, gzip compressed when the client accepts it.
+
+GO_NAMESPACES = ["biological_process", "cellular_component", "molecular_function"]
+GRAPHS = ["prot", "gene", "omim", "go"]
+SEPARATOR = "\u001f"
+
+
+class SyntheticGraphs:
+    def __init__(self, entities):
+        self.entities = entities
+        self.uris = {}
+
+    def graph_uris(self, graph, namespace=None):
+        key = (graph, namespace)
+        if key not in self.uris:
+            uris = []
+            for i in range(self.entities):
+                if namespace and GO_NAMESPACES[i % 3] != namespace:
+                    continue
+                uris.append("http://rdf.biogateway.eu/%s/E%08d" % (graph, i))
+            self.uris[key] = uris
+        return self.uris[key]
+
+    def field_values(self, field, uri, index):
+        if field == "synonyms":
+            return ["Synonym %d-%d" % (index, n) for n in range(index % 4)]
+        if field == "instances":
+            return ["http://rdf.biogateway.eu/instance/%d-%d" % (index, n) for n in range(index % 3)]
+        if field == "taxon":
+            return ["http://purl.bioontology.org/ontology/NCBITAXON/%d" % (9606 + index % 5)]
+        if field == "annotationScore":
+            return [str(index % 5 + 1)]
+        return []
+
+    def rows(self, query):
+        graph = re.search(r"graph/([\w]+)>", query).group(1)
+        namespace = re.search(r'hasOBONamespace> "(\w+)"', query)
+        uris = self.graph_uris(graph, namespace.group(1) if namespace else None)
+        after = re.search(r'FILTER\(STR\(\?uri\) > "((?:[^"\\]|\\.)*)"\)', query)
+        start = bisect.bisect_right(uris, after.group(1)) if after else 0
+        kind = query_kind(query)
+        for position in range(start, len(uris)):
+            uri = uris[position]
+            index = int(uri[-8:])
+            if kind == "labels":
+                definition = '"Definition of %s"' % uri[-9:] if index % 3 else ""
+                yield ['"%s"' % uri, '"LABEL%d"@en' % index, definition]
+            elif kind == "scores":
+                yield ["<%s>" % uri]
+            elif kind == "degree":
+                # Every entity is the object of index % 97 + 1 and the subject of index % 13 + 1 triples.
+                inbound = "?node ?relation ?uri" in query
+                yield ["<%s>" % uri, str(index % 97 + 1 if inbound else index % 13 + 1)]
+            elif kind == "combined":
+                yield ['"%s"' % uri] + self.combined_cells(query, uri, index)
+            else:
+                for value in self.field_values(kind, uri, index):
+                    yield ['"%s"' % uri, '"%s"' % value]
+
+    def combined_cells(self, query, uri, index):
+        cells = []
+        if "?prefLabel" in query:
+            cells += ['"LABEL%d"@en' % index, '"Definition of %s"' % uri[-9:] if index % 3 else ""]
+        for field in ["synonyms", "taxon", "instances", "annotationScore"]:
+            if "AS ?" + field + ")" in query:
+                values = self.field_values(field, uri, index)
+                cells.append('"%s"' % SEPARATOR.join(values) if values else "")
+        return cells
+
+
+def query_kind(query):
+    if "?degree" in query:
+        return "degree"
+    if "GROUP BY ?uri" in query:
+        return "combined"
+    if re.search(r"SELECT DISTINCT \?uri\s+WHERE", query):
+        return "scores"
+    if "?prefLabel" in query:
+        return "labels"
+    if "skos:altLabel" in query:
+        return "synonyms"
+    if "BFO_0000052" in query:
+        return "taxon"
+    if "evidenceOrigin" in query:
+        return "instances"
+    if "evidenceLevel" in query:
+        return "annotationScore"
+    raise ValueError("Unrecognised query")
+
+
+def page(rows, query, header):
+    yield header
+    limit = re.search(r"\nLIMIT (\d+)", query)
+    offset = re.search(r"\nOFFSET (\d+)", query)
+    skip = int(offset.group(1)) if offset else 0
+    remaining = int(limit.group(1)) if limit else None
+    for row in rows:
+        if skip:
+            skip -= 1
+            continue
+        if remaining is not None:
+            if remaining == 0:
+                return
+            remaining -= 1
+        yield row
+
+
+class SparqlHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    graphs = None
+    compress = True
+
+    def do_GET(self):
+        parameters = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        query = parameters.get("query", [""])[0]
+        try:
+            rows = self.answer(query)
+        except (ValueError, AttributeError) as error:
+            self.send_error(400, str(error))
+            return
+        compressor = None
+        if self.compress and "gzip" in self.headers.get("Accept-Encoding", ""):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/tab-separated-values; charset=UTF-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        if compressor:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        self.write_rows(rows, compressor)
+
+    def answer(self, query):
+        count = re.match(r"\s*SELECT COUNT\(\?uri\)\s*WHERE \{(.*)\}\s*$", query, re.S)
+        if count:
+            total = sum(1 for _ in self.graphs.rows(count.group(1)))
+            return iter([['"callret-0"'], [str(total)]])
+        if "SELECT DISTINCT ?graph" in query:
+            return iter([["?graph"]] + [["<http://rdf.biogateway.eu/graph/%s>" % graph] for graph in GRAPHS])
+        return page(self.graphs.rows(query), query, header=["?uri", "?value"])
+
+    def write_rows(self, rows, compressor=None):
+        lines = []
+        for row in rows:
+            lines.append("\t".join(row) + "\n")
+            if len(lines) == 10000:
+                self.write_chunk("".join(lines).encode("utf-8"), compressor)
+                lines = []
+        self.write_chunk("".join(lines).encode("utf-8"), compressor)
+        if compressor:
+            self.write_chunk(compressor.flush())
+        self.wfile.write(b"0\r\n\r\n")
+
+    def write_chunk(self, data, compressor=None):
+        if compressor:
+            data = compressor.compress(data)
+        if data:
+            self.wfile.write(b"%x\r\n" % len(data) + data + b"\r\n")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(entities, port=0, compress=True):
+    SparqlHandler.graphs = SyntheticGraphs(entities)
+    SparqlHandler.compress = compress
+    server = ThreadingHTTPServer(("127.0.0.1", port), SparqlHandler)
+    server.daemon_threads = True
+    return server
+
+
+def start_background_server(entities, port=0, compress=True):
+    server = start_server(entities, port, compress)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve synthetic BioGateway graphs over a local /sparql/ TSV endpoint.')
+    parser.add_argument('--port', type=int, default=8890, help='Port to listen on.')
+    parser.add_argument('--entities', type=int, default=100000, help='Number of entities in each synthetic graph.')
+    parser.add_argument('--no-gzip', default=False, dest='no_gzip', action='store_true', help='Never compress the responses.')
+    args = parser.parse_args()
+    server = start_server(args.entities, args.port, not args.no_gzip)
+    print("Serving %d entities per graph on http://127.0.0.1:%d/sparql/" % (args.entities, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
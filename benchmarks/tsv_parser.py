@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from updaters import read_tsv_rows
+
+
+def write_synthetic_labels(path, lines):
+    random.seed(0)
+    with open(path, "wb") as file:
+        file.write(b"?uri\t?prefLabel\t?definition\n")
+        for i in range(lines):
+            uri = "\"http://rdf.biogateway.eu/prot/P%08d\"" % i
+            label = "\"PROT%d_HUMAN\"@en" % random.randint(0, 99999)
+            if i % 50 == 0:
+                definition = "\"Protein %d, member of the \\\"family\\\" %d\"@en" % (i, i % 97)
+            elif i % 3:
+                definition = "\"Protein %d, member of family %d\"" % (i, i % 97)
+            else:
+                definition = ""
+            file.write(("%s\t%s\t%s\n" % (uri, label, definition)).encode("utf-8"))
+
+
+def split_lines(path):
+    rows = 0
+    with open(path, "rb") as data:
+        firstLine = True
+        for line in data:
+            if firstLine:
+                firstLine = False
+                continue
+            comps = line.decode("utf-8").replace("\"", "").replace("\n", "").split("\t")
+            rows += 1
+    return rows
+
+
+def stream_rows(path):
+    rows = 0
+    with open(path, "rb", buffering=0) as data:
+        for row in read_tsv_rows(data):
+            rows += 1
+    return rows
+
+
+def measure(name, function, path, repeat):
+    # The best of several runs, since the two readers are close and a single run is easily disturbed.
+    duration = float("inf")
+    for _ in range(repeat):
+        startTime = time.perf_counter()
+        rows = function(path)
+        duration = min(duration, time.perf_counter() - startTime)
+    print("%-16s %10d rows %8.2fs %12d rows/s" % (name, rows, duration, rows / duration))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the streaming TSV reader with line splitting.')
+    parser.add_argument('--lines', type=int, default=3000000, help='Number of synthetic result lines.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each reader; the fastest is reported.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "labels.tsv")
+        write_synthetic_labels(path, args.lines)
+        print("Synthetic file: %d lines, %.1f MB" % (args.lines, os.path.getsize(path) / 1e6))
+        measure("split", split_lines, path, args.repeat)
+        measure("read_tsv_rows", stream_rows, path, args.repeat)
@@ -0,0 +1,101 @@
+import gzip
+import hashlib
+import os
+import time
+
+from http_client import request
+
+
+class CachingStream:
+    # Passes a SPARQL response through while writing a compressed copy. The copy only becomes a cache entry
+    # once the response has been read to the end, so interrupted downloads are never replayed.
+    def __init__(self, response, path, context):
+        self.response = response
+        self.path = path
+        self.context = context
+        self.temporaryPath = path + "." + str(os.getpid()) + ".tmp"
+        self.copy = gzip.open(self.temporaryPath, "wb", compresslevel=3)
+
+    def read(self, size=-1):
+        try:
+            chunk = self.response.read(size)
+        except Exception:
+            self.discard()
+            raise
+        if chunk:
+            self.copy.write(chunk)
+        elif self.copy:
+            self.copy.close()
+            self.copy = None
+            os.replace(self.temporaryPath, self.path)
+            evict(self.context)
+        return chunk
+
+    def discard(self):
+        if self.copy:
+            self.copy.close()
+            self.copy = None
+            os.remove(self.temporaryPath)
+
+    def close(self):
+        self.discard()
+        self.response.close()
+
+    def __del__(self):
+        try:
+            self.discard()
+        except OSError:
+            pass
+
+
+def cache_path(context, url):
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    directory = os.path.join(context.cache_dir, key[:2])
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, key + ".tsv.gz")
+
+
+def open_url(context, url):
+    # The url holds the endpoint, the query text and its page, so it is used as the cache key.
+    if not context.cache_dir:
+        return request(url, context.timeout or None, context.http_retries)
+    path = cache_path(context, url)
+    if os.path.exists(path):
+        if time.time() - os.path.getmtime(path) < context.cache_ttl * 3600:
+            os.utime(path, (time.time(), os.path.getmtime(path)))
+            return gzip.open(path, "rb")
+        os.remove(path)
+    return CachingStream(request(url, context.timeout or None, context.http_retries), path, context)
+
+
+def evict(context):
+    # Removes expired entries, then the least recently used ones until the cache fits in cache_size GB.
+    entries = []
+    now = time.time()
+    for directory, _, files in os.walk(context.cache_dir):
+        for name in files:
+            if not name.endswith(".tsv.gz"):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if now - stat.st_mtime >= context.cache_ttl * 3600:
+                remove_entry(path)
+            else:
+                entries.append((stat.st_atime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    limit = context.cache_size * 1e9
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        remove_entry(path)
+        total -= size
+
+
+def remove_entry(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,189 @@
+import os
+import socket
+import threading
+import time
+from dataclasses import replace
+
+import gridfs
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from scheduler import data_type_key, timestamp
+from scores import table_path, write_table_file
+
+# Coordinator/worker mode. The coordinator stores the jobs of a run in the _tasks collection of the target
+# database, next to a _run document with the settings of the run. Workers on any host claim a task by
+# atomically setting its owner and a lease, renew the lease while they run it, and record its progress and
+# result. Tasks whose lease ran out, because their worker died, can be claimed by any other worker.
+# The coordinator also counts the relations behind the scores once and stores the degree tables in the
+# _degrees GridFS bucket; each host downloads the tables of the scores tasks its workers claim.
+
+tasks_collection = "_tasks"
+run_id = "_run"
+degrees_bucket = "_degrees"
+
+
+def task_id(job):
+    return data_type_key(job.dataType) + "/" + job.name + "/" + str(job.offset)
+
+
+def worker_name():
+    return socket.gethostname() + ":" + str(os.getpid())
+
+
+class TaskQueue:
+    def __init__(self, mdb, lease=60):
+        self.collection = mdb[tasks_collection]
+        self.lease = lease
+
+    def publish(self, run, jobs, resume=False):
+        # A resumed run keeps the status and progress of the tasks it already published.
+        if not resume:
+            self.collection.drop()
+        self.collection.create_index([("status", ASCENDING), ("leaseUntil", ASCENDING)])
+        self.collection.replace_one({"_id": run_id}, dict(run, _id=run_id), upsert=True)
+        for job in jobs:
+            try:
+                self.collection.insert_one({"_id": task_id(job), "dataType": data_type_key(job.dataType),
+                                            "field": job.name, "offset": job.offset, "count": job.count,
+                                            "size": job.size, "estimate": job.estimate, "after": job.after,
+                                            "status": "pending",
+                                            "attempts": 0})
+            except DuplicateKeyError:
+                self.collection.update_one({"_id": task_id(job), "status": "failed"},
+                                           {"$set": {"status": "pending", "attempts": 0}})
+
+    def run(self):
+        return self.collection.find_one({"_id": run_id})
+
+    def publish_tables(self, prefix, keys):
+        # Returns the version of the tables, which workers use to tell them from those of earlier runs.
+        bucket = gridfs.GridFSBucket(self.collection.database, degrees_bucket)
+        for key in keys:
+            for old in bucket.find({"filename": key}):
+                bucket.delete(old._id)
+            with open(table_path(prefix, key), "rb") as file:
+                bucket.upload_from_stream(key, file)
+        return str(int(time.time()))
+
+    def fetch_table(self, key, path):
+        bucket = gridfs.GridFSBucket(self.collection.database, degrees_bucket)
+        write_table_file(path, lambda file: bucket.download_to_stream_by_name(key, file), overwrite=False)
+
+    def claim(self, owner):
+        # The tasks estimated to take longest are claimed first, so the last ones to finish are short.
+        now = time.time()
+        return self.collection.find_one_and_update(
+            {"$or": [{"status": "pending"}, {"status": "running", "leaseUntil": {"$lt": now}}]},
+            {"$set": {"status": "running", "owner": owner, "leaseUntil": now + self.lease, "started": now}},
+            sort=[("estimate", DESCENDING), ("count", DESCENDING)], return_document=ReturnDocument.AFTER)
+
+    def heartbeat(self, id, owner):
+        result = self.collection.update_one({"_id": id, "owner": owner, "status": "running"},
+                                            {"$set": {"leaseUntil": time.time() + self.lease}})
+        return result.matched_count == 1
+
+    def progress(self, id, owner, after, rows):
+        self.collection.update_one({"_id": id, "owner": owner}, {"$set": {"after": after, "rows": rows}})
+
+    def finish(self, id, owner, rows):
+        self.collection.update_one({"_id": id, "owner": owner},
+                                   {"$set": {"status": "done", "rows": rows, "finished": time.time()}})
+
+    def fail(self, id, owner, error, retries):
+        task = self.collection.find_one_and_update({"_id": id, "owner": owner},
+                                                   {"$inc": {"attempts": 1}, "$set": {"error": error}},
+                                                   return_document=ReturnDocument.AFTER)
+        if task:
+            status = "pending" if task["attempts"] <= retries else "failed"
+            self.collection.update_one({"_id": id, "owner": owner},
+                                       {"$set": {"status": status, "finished": time.time()}})
+
+    def statuses(self):
+        counts = {}
+        for task in self.collection.find({"status": {"$exists": True}}, {"status": 1}):
+            counts[task["status"]] = counts.get(task["status"], 0) + 1
+        return counts
+
+    def failed(self):
+        return list(self.collection.find({"status": "failed"}))
+
+    def wait(self, poll=10):
+        # Used by the coordinator: returns the failed tasks once no task is pending or running.
+        while True:
+            counts = self.statuses()
+            print(timestamp() + "Tasks: " + ", ".join(str(count) + " " + status for status, count in sorted(counts.items())))
+            if not counts.get("pending") and not counts.get("running"):
+                return self.failed()
+            time.sleep(poll)
+
+
+class TaskEntry:
+    # The task a worker is running, with the interface of ledger.LedgerEntry. Failures are recorded by
+    # run_worker, which also sees the errors raised before the updater starts.
+    def __init__(self, queue, id, owner):
+        self.queue = queue
+        self.id = id
+        self.owner = owner
+
+    def start(self, after):
+        pass
+
+    def progress(self, after, rows):
+        self.queue.progress(self.id, self.owner, after, rows)
+
+    def finish(self, rows):
+        self.queue.finish(self.id, self.owner, rows)
+
+    def fail(self, error):
+        pass
+
+
+class Heartbeat(threading.Thread):
+    def __init__(self, queue, id, owner):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.id = id
+        self.owner = owner
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.queue.lease / 3):
+            if not self.queue.heartbeat(self.id, self.owner):
+                print(timestamp() + "Lost the lease on " + self.id + ", another worker has taken it over.")
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def run_worker(queue, context, targets, owner, poll=10):
+    # Claims and runs tasks until none is pending or running. targets maps the (DataType key, field) of a
+    # task to its (DataType, updater).
+    completed = 0
+    while True:
+        task = queue.claim(owner)
+        if task is None:
+            counts = queue.statuses()
+            if not counts.get("pending") and not counts.get("running"):
+                print(timestamp() + "No tasks left, " + owner + " ran " + str(completed) + " tasks.")
+                return completed
+            time.sleep(poll)
+            continue
+        dataType, target = targets[(task["dataType"], task["field"])]
+        print(timestamp() + owner + " claimed " + task["_id"] + (" after " + task["after"] if task["after"] else ""))
+        taskContext = replace(context, batch_size=task["size"] or context.batch_size, task=task["_id"], worker=owner)
+        heartbeat = Heartbeat(queue, task["_id"], owner)
+        heartbeat.start()
+        try:
+            if task["field"] == "scores" and context.scores_file:
+                queue.fetch_table(task["dataType"], table_path(context.scores_file, task["dataType"]))
+            target(dataType, taskContext, task["offset"], task["count"], after=task["after"])
+            completed += 1
+        except Exception as error:
+            print(timestamp() + "Task " + task["_id"] + " failed: " + repr(error))
+            queue.fail(task["_id"], owner, repr(error), context.retries)
+        finally:
+            heartbeat.stop()
+
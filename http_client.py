@@ -0,0 +1,135 @@
+import http.client
+import io
+import threading
+import time
+import urllib.error
+import urllib.parse
+import zlib
+
+# A small HTTP client for the SPARQL downloads. Connections to the endpoint are kept alive and reused by the
+# requests of a process, responses are requested with gzip or deflate and decompressed while they are read,
+# and requests that fail before their body arrives are retried with exponential backoff.
+
+MAX_IDLE_CONNECTIONS = 8
+COMPRESSED_CHUNK = 1 << 16
+
+idleConnections = {}
+idleLock = threading.Lock()
+
+
+def get_connection(key, timeout):
+    with idleLock:
+        idle = idleConnections.get(key)
+        if idle:
+            connection = idle.pop()
+            if connection.sock:
+                connection.sock.settimeout(timeout)
+            connection.timeout = timeout
+            return connection, True
+    return http.client.HTTPConnection(key[0], key[1], timeout=timeout), False
+
+
+def release_connection(key, connection):
+    with idleLock:
+        idle = idleConnections.setdefault(key, [])
+        if len(idle) < MAX_IDLE_CONNECTIONS:
+            idle.append(connection)
+            return
+    connection.close()
+
+
+def decompressor(encoding):
+    if encoding == "gzip":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == "deflate":
+        # Deflate bodies are meant to be zlib wrapped, but some servers send raw deflate; 32 + MAX_WBITS only
+        # detects zlib and gzip headers, so raw streams are recognised when the first chunk is read.
+        return zlib.decompressobj(32 + zlib.MAX_WBITS)
+    return None
+
+
+class Response:
+    # The body of one response. The connection goes back to the pool once the body has been read to the end;
+    # a response closed before that closes its connection, since the rest of the body is still on the wire.
+    def __init__(self, key, connection, response):
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.encoding = (response.getheader("Content-Encoding") or "").lower()
+        self.decompressor = decompressor(self.encoding)
+        self.wireBytes = 0
+        self.done = False
+
+    def read(self, size=-1):
+        if self.done:
+            return b""
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self.read(1 << 20), b""))
+        if self.decompressor is None:
+            chunk = self.response.read(size)
+            self.wireBytes += len(chunk)
+            if not chunk:
+                self.finish()
+            return chunk
+        while True:
+            data = self.decompressor.unconsumed_tail
+            if not data:
+                data = self.response.read(COMPRESSED_CHUNK)
+                self.wireBytes += len(data)
+                if not data:
+                    tail = self.decompressor.flush()
+                    self.finish()
+                    return tail
+            try:
+                output = self.decompressor.decompress(data, size)
+            except zlib.error:
+                if self.encoding != "deflate" or self.wireBytes > len(data):
+                    raise
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                output = self.decompressor.decompress(data, size)
+            if output:
+                return output
+
+    def finish(self):
+        self.done = True
+        if self.response.will_close:
+            self.connection.close()
+        else:
+            release_connection(self.key, self.connection)
+
+    def close(self):
+        if not self.done:
+            self.done = True
+            self.connection.close()
+
+
+def request(url, timeout=None, retries=3):
+    parts = urllib.parse.urlsplit(url)
+    key = (parts.hostname, parts.port or 80)
+    path = parts.path + ("?" + parts.query if parts.query else "")
+    headers = {"Accept-Encoding": "gzip, deflate", "Accept": "text/tab-separated-values"}
+    attempt = 0
+    while True:
+        connection, reused = get_connection(key, timeout)
+        try:
+            connection.request("GET", path, headers=headers)
+            response = connection.getresponse()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            # An idle connection may have been closed by the server in the meantime; that is not a failure.
+            if reused:
+                continue
+            if attempt >= retries:
+                raise
+            attempt += 1
+            time.sleep(min(2 ** attempt * 0.5, 30))
+            continue
+        if response.status == 200:
+            return Response(key, connection, response)
+        body = response.read()
+        connection.close()
+        if response.status >= 500 and attempt < retries:
+            attempt += 1
+            time.sleep(min(2 ** attempt * 0.5, 30))
+            continue
+        raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
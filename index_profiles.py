@@ -0,0 +1,184 @@
+import re
+import statistics
+import time
+
+from pymongo import ASCENDING, DESCENDING, IndexModel, MongoClient
+
+from scheduler import timestamp
+from writer import BulkWriter
+
+# Read-side index profiles. The load maintains only the single field indexes of updaters.collection_indexes;
+# after it, each collection can get the compound indexes its lookups need and a "prefixes" array with the
+# word prefixes of its label and synonyms for autocomplete. Once a collection has a profile, later loads
+# recompute the prefixes of the documents whose texts changed, and a rebuilt collection gets the profile of
+# the one it replaces. Every profile comes with representative queries, which are explained and timed before
+# and after the profile is built.
+
+MIN_PREFIX = 2
+MAX_PREFIX = 12
+QUERY_RUNS = 5
+word_pattern = re.compile(r"[^0-9a-z]+")
+
+
+class IndexProfile:
+    def __init__(self, name, indexes, taxon=False):
+        self.name = name
+        self.indexes = indexes
+        self.taxon = taxon
+
+    def queries(self, sample):
+        # (name, baseline filter, filter served by the profile) of the lookups the front end makes, with the
+        # values taken from a sample document. Both filters of a row match the same documents: autocomplete
+        # finds words starting with the prefix, which the baseline does with a regex anchored at the start of
+        # the text or after a separator. Results are always sorted by refScore and limited.
+        prefix = re.escape(sample["prefix"])
+        wordStart = "(^|[^0-9a-z])" + prefix
+        scope = {"taxon": sample["taxon"]} if self.taxon and sample.get("taxon") else {}
+        return [
+            ("label prefix", dict(scope, lcLabel={"$regex": "^" + prefix}),
+             dict(scope, lcLabel={"$regex": "^" + prefix})),
+            ("synonym prefix", dict(scope, lcSynonyms={"$regex": "^" + prefix}),
+             dict(scope, lcSynonyms={"$regex": "^" + prefix})),
+            ("autocomplete", dict(scope, **{"$or": [{"lcLabel": {"$regex": wordStart}},
+                                                    {"lcSynonyms": {"$regex": wordStart}}]}),
+             dict(scope, prefixes=sample["prefix"]))]
+
+
+entity_indexes = [
+    IndexModel([("lcLabel", ASCENDING), ("refScore", DESCENDING)], name="profile_label_score"),
+    IndexModel([("lcSynonyms", ASCENDING), ("refScore", DESCENDING)], name="profile_synonyms_score"),
+    IndexModel([("prefixes", ASCENDING), ("refScore", DESCENDING)], name="profile_prefixes_score")]
+
+# Equality on taxon first, then the sort on refScore, then the prefix range, so a lookup within one organism
+# reads its index entries already in score order.
+taxon_indexes = entity_indexes + [
+    IndexModel([("taxon", ASCENDING), ("refScore", DESCENDING), ("lcLabel", ASCENDING)], name="profile_taxon_score_label"),
+    IndexModel([("taxon", ASCENDING), ("prefixes", ASCENDING), ("refScore", DESCENDING)],
+               name="profile_taxon_prefixes_score")]
+
+relation_indexes = [
+    IndexModel([("lcLabel", ASCENDING)], name="profile_label"),
+    IndexModel([("prefixes", ASCENDING)], name="profile_prefixes")]
+
+index_profiles = {
+    "prot": IndexProfile("taxon entities", taxon_indexes, taxon=True),
+    "gene": IndexProfile("taxon entities", taxon_indexes, taxon=True),
+    "omim": IndexProfile("entities", entity_indexes),
+    "gobp": IndexProfile("entities", entity_indexes),
+    "gocc": IndexProfile("entities", entity_indexes),
+    "gomf": IndexProfile("entities", entity_indexes),
+    "goall": IndexProfile("entities", entity_indexes),
+    "prot2prot": IndexProfile("relations", relation_indexes),
+    "prot2onto": IndexProfile("relations", relation_indexes),
+    "tfac2gene": IndexProfile("relations", relation_indexes)}
+
+
+def prefix_tokens(texts):
+    tokens = set()
+    for text in texts:
+        if not isinstance(text, str):
+            continue
+        for word in word_pattern.split(text) + [text]:
+            for length in range(MIN_PREFIX, min(len(word), MAX_PREFIX) + 1):
+                tokens.add(word[:length])
+    return sorted(tokens)
+
+
+def has_profile(collection):
+    return collection.name in index_profiles and \
+        any(index.startswith("profile_") for index in collection.index_information())
+
+
+def write_prefixes(db, name, flush_size=1000):
+    # Recomputes the prefixes of every document from its lcLabel and lcSynonyms and writes those that
+    # changed, so the prefixes of a replaced label or synonym do not linger.
+    writer = BulkWriter(db, flush_size, "prefixes")
+    for document in db[name].find({}, {"lcLabel": 1, "lcSynonyms": 1, "prefixes": 1}):
+        texts = [document.get("lcLabel")] + list(document.get("lcSynonyms") or [])
+        prefixes = prefix_tokens(texts)
+        if prefixes != document.get("prefixes", []):
+            writer.update(db[name], document["_id"], {"$set": {"prefixes": prefixes}})
+    writer.flush()
+    return writer.written
+
+
+def refresh_prefixes(dbName, names, mongoUri, flush_size=1000):
+    # Keeps the prefixes of collections that already have a profile in step with a load that changed their
+    # labels or synonyms.
+    db = MongoClient(mongoUri)[dbName]
+    for name in names:
+        if has_profile(db[name]):
+            written = write_prefixes(db, name, flush_size)
+            print(timestamp() + "Updated the prefixes of " + str(written) + " " + name + " documents")
+
+
+def sample_values(collection):
+    # The best scored document with a label stands in for what users look up.
+    document = collection.find_one({"lcLabel": {"$exists": True}}, sort=[("refScore", DESCENDING)])
+    if not document:
+        return None
+    words = [word for word in word_pattern.split(document["lcLabel"]) if len(word) >= MIN_PREFIX]
+    return {"prefix": (words[0] if words else document["lcLabel"])[:3], "taxon": document.get("taxon")}
+
+
+def plan_summary(explain):
+    # The stages of the winning plan, outermost first, with the index of each index scan.
+    plan = explain["queryPlanner"]["winningPlan"]
+    plan = plan.get("queryPlan", plan)
+    stages = []
+    while plan:
+        stage = plan.get("stage", "?")
+        if plan.get("indexName"):
+            stage += "(" + plan["indexName"] + ")"
+        stages.append(stage)
+        children = plan.get("inputStages") or [plan.get("inputStage")]
+        plan = children[0]
+    stats = explain.get("executionStats", {})
+    return ">".join(stages), stats.get("totalDocsExamined", 0), stats.get("totalKeysExamined", 0)
+
+
+def measure(collection, filter):
+    cursor = lambda: collection.find(filter, {"_id": 1}).sort("refScore", DESCENDING).limit(10)
+    durations = []
+    for _ in range(QUERY_RUNS):
+        startTime = time.perf_counter()
+        list(cursor())
+        durations.append((time.perf_counter() - startTime) * 1000)
+    plan, docsExamined, keysExamined = plan_summary(cursor().explain())
+    return {"plan": plan, "docs": docsExamined, "keys": keysExamined, "ms": statistics.median(durations),
+            "ids": set(document["_id"] for document in collection.find(filter, {"_id": 1}))}
+
+
+def build_index_profiles(dbName, names, mongoUri, flush_size=1000):
+    db = MongoClient(mongoUri)[dbName]
+    for name in names:
+        profile = index_profiles.get(name)
+        sample = sample_values(db[name]) if profile else None
+        if not sample:
+            continue
+        queries = profile.queries(sample)
+        before = [measure(db[name], baseline) for _, baseline, _ in queries]
+
+        startTime = time.time()
+        print(timestamp() + "Building the " + profile.name + " index profile of " + name + "...")
+        written = write_prefixes(db, name, flush_size)
+        db[name].create_indexes(profile.indexes)
+        print(timestamp() + "Built the index profile of " + name + " (" + str(written) + " prefix arrays) in " +
+              time.strftime("%H:%M:%S.", time.gmtime(time.time() - startTime)))
+
+        after = [measure(db[name], profiled) for _, _, profiled in queries]
+        report_profile(name, sample, queries, before, after)
+
+
+def report_profile(name, sample, queries, before, after):
+    print(timestamp() + "Lookups on " + name + " for prefix '" + sample["prefix"] + "'" +
+          (" in taxon " + str(sample["taxon"]) if sample.get("taxon") else "") + ":")
+    print("%-16s %10s %10s %8s %10s %10s %8s  %s" % ("query", "ms before", "ms after", "gain", "docs before",
+                                                   "docs after", "matches", "plan after"))
+    for (query, _, _), old, new in zip(queries, before, after):
+        gain = old["ms"] / new["ms"] if new["ms"] else 0
+        # A gain only counts if both filters found the same documents.
+        matches = str(len(new["ids"])) if old["ids"] == new["ids"] else "DIFFER"
+        print("%-16s %10.2f %10.2f %7.1fx %10d %10d %8s  %s" % (query, old["ms"], new["ms"], gain, old["docs"],
+                                                                new["docs"], matches, new["plan"]))
+
@@ -0,0 +1,116 @@
+import sqlite3
+import time
+
+from scheduler import data_type_key
+
+# Every (DataType, field, offset) job of a run is a row in a SQLite file. Worker processes open their own
+# connection, mark their job running, store the uri of every completed keyset page and finally mark it done
+# or failed, so --resume can skip the finished jobs and continue the others from their last page.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    dataType TEXT NOT NULL,
+    field TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    after TEXT,
+    status TEXT NOT NULL,
+    rows INTEGER NOT NULL DEFAULT 0,
+    started REAL,
+    finished REAL,
+    error TEXT,
+    PRIMARY KEY (dataType, field, offset))
+"""
+
+
+class Ledger:
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def reset(self):
+        self.connection.execute("DELETE FROM jobs")
+
+    def plan(self, key, field, offset):
+        self.connection.execute("INSERT OR IGNORE INTO jobs (dataType, field, offset, status) VALUES (?, ?, ?, 'pending')",
+                                (key, field, offset))
+
+    def start(self, key, field, offset, after):
+        self.connection.execute(
+            "INSERT INTO jobs (dataType, field, offset, after, status, started) VALUES (?, ?, ?, ?, 'running', ?) "
+            "ON CONFLICT (dataType, field, offset) DO UPDATE SET status = 'running', after = excluded.after, "
+            "started = COALESCE(jobs.started, excluded.started), error = NULL",
+            (key, field, offset, after, time.time()))
+
+    def progress(self, key, field, offset, after, rows):
+        self.connection.execute("UPDATE jobs SET after = ?, rows = ? WHERE dataType = ? AND field = ? AND offset = ?",
+                                (after, rows, key, field, offset))
+
+    def finish(self, key, field, offset, rows):
+        self.connection.execute("UPDATE jobs SET status = 'done', rows = ?, finished = ? "
+                                "WHERE dataType = ? AND field = ? AND offset = ?",
+                                (rows, time.time(), key, field, offset))
+
+    def fail(self, key, field, offset, error):
+        self.connection.execute("UPDATE jobs SET status = 'failed', error = ?, finished = ? "
+                                "WHERE dataType = ? AND field = ? AND offset = ?",
+                                (error, time.time(), key, field, offset))
+
+    def job(self, key, field, offset):
+        return self.connection.execute("SELECT status, after FROM jobs WHERE dataType = ? AND field = ? AND offset = ?",
+                                       (key, field, offset)).fetchone()
+
+    def field_done(self, key, field):
+        statuses = [status for status, in self.connection.execute(
+            "SELECT status FROM jobs WHERE dataType = ? AND field = ?", (key, field))]
+        return bool(statuses) and all(status == "done" for status in statuses)
+
+    def summary(self):
+        return dict(self.connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+
+class LedgerEntry:
+    # The row of the job a worker is running.
+    def __init__(self, ledger, key, field, offset):
+        self.ledger = ledger
+        self.key = key
+        self.field = field
+        self.offset = offset
+
+    def start(self, after):
+        self.ledger.start(self.key, self.field, self.offset, after)
+
+    def progress(self, after, rows):
+        self.ledger.progress(self.key, self.field, self.offset, after, rows)
+
+    def finish(self, rows):
+        self.ledger.finish(self.key, self.field, self.offset, rows)
+
+    def fail(self, error):
+        self.ledger.fail(self.key, self.field, self.offset, error)
+
+
+def open_ledger(context):
+    if not context.ledger:
+        return None
+    return Ledger(context.ledger)
+
+
+def resume_jobs(context, jobs):
+    # Drops the jobs the ledger has as done and continues keyset jobs after their last completed page.
+    ledger = Ledger(context.ledger)
+    remaining = []
+    for job in jobs:
+        entry = ledger.job(data_type_key(job.dataType), job.name, job.offset)
+        if entry and entry[0] == "done":
+            continue
+        if entry and entry[1]:
+            job.after = entry[1]
+        remaining.append(job)
+    ledger.close()
+    return remaining
+
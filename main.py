@@ -2,9 +2,18 @@
 import argparse
 import logging
 import multiprocessing as mp
-from dataclasses import dataclass
+import os
+import tempfile
+from dataclasses import asdict, dataclass, replace
 
 from updaters import *
+from scheduler import data_type_key, run_jobs, run_serial, timestamp
+from ledger import Ledger, resume_jobs
+from coordination import TaskQueue, run_worker, worker_name
+from planner import plan_fields, print_plan
+from async_engine import run_async
+from metrics import print_summary
+from index_profiles import build_index_profiles, refresh_prefixes
 
 format = "%(asctime)s: %(message)s"
 logging.basicConfig(format=format, level=logging.INFO, datefmt="%H:%M:%S")
@@ -33,51 +42,35 @@ class UpdateContext:
     wipeData: bool
     batch_size: int
     parallel: bool
-
-def timestamp():
-    return "[" + time.strftime("%H:%M:%S", time.localtime()) + "] "
-
-if __name__ == '__main__':
-    startTime = time.time()
-    mp.set_start_method('spawn')
-    parser = argparse.ArgumentParser(
-        description='Update the BioGateway Metadata Cache with new data from the SPARQL endpoint.')
-    parser.add_argument('hostname', metavar='hostname', type=str,
-                        help='The hostname of the BioGateway SPARQL endpoint to be loaded from.')
-    parser.add_argument('port', metavar='port', type=str,
-                        help='The port of the BioGateway SPARQL endpoint to be loaded from.')
-    parser.add_argument('dbName', metavar='db-name', type=str, help='The MongoDB database to store the cached data')
-    parser.add_argument('--datatype', type=str, help='Limit update to this data type.')
-    parser.add_argument('--field', type=str, help='Limit update to this field type.')
-    parser.add_argument('--batchsize', type=int, default=2000000, dest='batchsize', help='Batches the queries to N entries of each data type.')
-    parser.add_argument('--drop', default=False, dest='drop', action='store_true', help='Drop all data from the database before updating.')
-    parser.add_argument('--wipe', default=False, dest='wipe', action='store_true', help='Wipe all data from the collections being updated.')
-    parser.add_argument('--parallel', default=False, dest='parallel', action='store_true', help='Run in parallel. This might cause instabilities.')
-
-    args = parser.parse_args()
-
-    baseUrl = args.hostname + ":" + args.port
-    dbName = args.dbName
-    wipeData = args.wipe
-    query_batch_size = args.batchsize
-    parallel = args.parallel
-    dropDatabase = args.drop
-
-    headerText = """
-    %s          -------------------           METADATABASE UPDATER          -------------------
-    %s                Updater tool for downloading and caching the BioGateway metadatabase.    
-    %s                Parameters: <hostname:port> <db-name> (Optional)<datatype> (Optional)<fieldType>  
-    %s                Connecting to endpoint on:        %s
-    %s                Updating database:                %s
-    %s                Parallel:                         %s
-    %s          -------------------------------------------------------------------------------
-    """ % (timestamp(), timestamp(), timestamp(), timestamp(), baseUrl, timestamp(), dbName, timestamp(), parallel, timestamp())
-
-    print(headerText)
-
-    print(timestamp() + 'Loading data into ' + dbName + ' using port ' + baseUrl + '...')
-
-    dataTypes = [
+    flush_size: int = 1000
+    workers: int = 4
+    sparql_connections: int = 0
+    mongo_connections: int = 0
+    retries: int = 2
+    incremental: bool = False
+    rebuild: bool = False
+    pagination: str = "offset"
+    cache_dir: str = ""
+    cache_ttl: float = 168
+    cache_size: float = 50
+    queue_depth: int = 8
+    metrics_file: str = ""
+    profile_dir: str = ""
+    profiler: str = "cprofile"
+    adaptive: bool = False
+    batch_state: str = "batch_sizes.json"
+    page_seconds: float = 60
+    timeout: float = 0
+    ledger: str = ""
+    scores_file: str = ""
+    mongo_uri: str = "mongodb://localhost:27017/"
+    task: str = ""
+    worker: str = ""
+    group_buffer: int = 100000
+    http_retries: int = 3
+
+def data_types():
+    return [
         DataType("prot", [DatabaseCollection("prot")],
                  "?uri rdfs:subClassOf <http://semanticscience.org/resource/SIO_010043> .", True, True, True, True, True),
         DataType("gene", [DatabaseCollection("gene")],
@@ -94,8 +87,9 @@ if __name__ == '__main__':
         DataType("tfac2gene", [DatabaseCollection("tfac2gene")], "", True, False)
     ]
 
-    limitToDatatype = args.datatype
-    limitToFieldType = args.field
+
+def select_data_types(limitToDatatype=None, limitToFieldType=None):
+    dataTypes = data_types()
 
     if limitToDatatype:
         dataTypes = list(filter(lambda x: x.graph == limitToDatatype, dataTypes))
@@ -128,68 +122,282 @@ if __name__ == '__main__':
                 dataType.taxon = False
                 dataType.instances = False
                 dataType.annotationScores = True
+    return dataTypes
 
-    if dropDatabase:
-        print("Dropping database " + dbName + "and rebuilding indexes.")
-        drop_and_reset_database(dbName)
-        print("Database " + dbName + " has been reset.")
-
-    print(timestamp() + "Updating:")
-    print(*dataTypes, sep="\n")
-
-    context = UpdateContext(args.hostname + ":" + args.port, args.dbName, args.wipe, args.batchsize, args.parallel)
 
+def field_tasks(dataTypes, combined=False):
+    # The (DataType, field name, updater) of every field to load, in the order they are run.
+    tasks = []
 
     for dataType in dataTypes:
-        if wipeData:
-            for collection in dataType.dbCollections:
-                print("Wiping collection: " + collection.name)
-                collection.reference.delete_many({})
+        if combined and combined_fields(dataType):
+            tasks.append((dataType, "combined", update_combined))
+            dataType = replace(dataType, labels=False, taxon=False, instances=False, annotationScores=False)
 
-    processes = []
-
-    for dataType in dataTypes:
         if dataType.labels:
-            if parallel:
-                processes.extend(startBatches(dataType, "labels", update_labels, context))
-                processes.extend(startBatches(dataType, "synonyms", update_synonyms, context))
-            else:
-                update_labels(dataType, context)
-                update_synonyms(dataType, context)
+            tasks.append((dataType, "labels", update_labels))
+            tasks.append((dataType, "synonyms", update_synonyms))
 
         if dataType.scores:
-            if parallel:
-                processes.extend(startBatches(dataType, "scores", update_scores, context))
-
-            else:
-                update_scores(dataType, context)
+            tasks.append((dataType, "scores", update_scores))
 
         if dataType.taxon:
-            if parallel:
-                processes.extend(startBatches(dataType, "taxon", update_taxon, context))
-            else:
-                update_taxon(dataType, context)
+            tasks.append((dataType, "taxon", update_taxon))
 
         if dataType.instances:
-            if parallel:
-                processes.extend(startBatches(dataType, "instances", update_instances, context))
-            else:
-                update_instances(dataType, context)
+            tasks.append((dataType, "instances", update_instances))
 
         if dataType.annotationScores:
-            if parallel:
-                processes.extend(startBatches(dataType, "annotation score", update_annotationScore, context))
-            else:
-                update_annotationScore(dataType, context)
+            tasks.append((dataType, "annotation score", update_annotationScore))
+    return tasks
 
-    # Start all processes:
-    print(timestamp() + "Starting " + str(len(processes)) + " workers...")
-    for process in processes:
-        process.start()
 
-    # Wait for all processes to complete:
-    for process in processes:
-        process.join()
+if __name__ == '__main__':
+    startTime = time.time()
+    mp.set_start_method('spawn')
+    parser = argparse.ArgumentParser(
+        description='Update the BioGateway Metadata Cache with new data from the SPARQL endpoint.')
+    parser.add_argument('hostname', metavar='hostname', type=str,
+                        help='The hostname of the BioGateway SPARQL endpoint to be loaded from.')
+    parser.add_argument('port', metavar='port', type=str,
+                        help='The port of the BioGateway SPARQL endpoint to be loaded from.')
+    parser.add_argument('dbName', metavar='db-name', type=str, help='The MongoDB database to store the cached data')
+    parser.add_argument('--datatype', type=str, help='Limit update to this data type.')
+    parser.add_argument('--field', type=str, help='Limit update to this field type.')
+    parser.add_argument('--batchsize', type=int, default=2000000, dest='batchsize', help='Batches the queries to N entries of each data type.')
+    parser.add_argument('--adaptive', default=False, dest='adaptive', action='store_true', help='Adjust the batch size of every data type and field to the response times and errors of the endpoint, starting from the sizes learned by earlier runs.')
+    parser.add_argument('--batch-state', type=str, default="batch_sizes.json", dest='batch_state', help='File where --adaptive stores the learned batch sizes.')
+    parser.add_argument('--page-seconds', type=float, default=60, dest='page_seconds', help='Response time per page that --adaptive aims for.')
+    parser.add_argument('--timeout', type=float, default=0, dest='timeout', help='Seconds without data from the endpoint before a request fails. 0 waits forever.')
+    parser.add_argument('--http-retries', type=int, default=3, dest='http_retries', help='Times a SPARQL request that fails before its response arrives is retried, with exponential backoff.')
+    parser.add_argument('--pagination', choices=['keyset', 'offset'], default=None, dest='pagination', help='Page through results with LIMIT/OFFSET batches (the default of the process engine), or ordered by uri (keyset), which runs every field as a single job. The async engine always pages by key.')
+    parser.add_argument('--flushsize', type=int, default=1000, dest='flushsize', help='Number of documents buffered per collection before each bulk write.')
+    parser.add_argument('--group-buffer', type=int, default=100000, dest='group_buffer', help='Documents of synonyms and instances held in memory per offset batch while their rows are grouped, before spilling to disk. 0 disables the grouping.')
+    parser.add_argument('--queue-depth', type=int, default=8, dest='queue_depth', help='Chunks and flushes buffered between the download, parse and write stages of a worker. 0 runs the stages sequentially.')
+    parser.add_argument('--metrics', type=str, default="", dest='metrics_file', help='Append per batch metrics as JSON lines to this file and print a summary at the end.')
+    parser.add_argument('--profile', type=str, default="", dest='profile_dir', help='Write a profile of every worker job to this directory.')
+    parser.add_argument('--profiler', choices=['cprofile', 'pyinstrument'], default='cprofile', dest='profiler', help='Profiler used with --profile.')
+    parser.add_argument('--drop', default=False, dest='drop', action='store_true', help='Drop all data from the database before updating.')
+    parser.add_argument('--wipe', default=False, dest='wipe', action='store_true', help='Wipe all data from the collections being updated.')
+    parser.add_argument('--incremental', default=False, dest='incremental', action='store_true', help='Only write documents whose fields changed, and remove documents no longer in the source. Synonyms and instances are paged by key so their arrays can be replaced whole; a document that lost all of them keeps its old values.')
+    parser.add_argument('--rebuild', default=False, dest='rebuild', action='store_true', help='Load into shadow collections without indexes, then index them and swap them in atomically.')
+    parser.add_argument('--combined', default=False, dest='combined', action='store_true', help='Fetch all fields except scores of each data type in a single query.')
+    parser.add_argument('--cache', type=str, default="", dest='cache_dir', help='Directory for caching the SPARQL responses so they can be replayed by later runs.')
+    parser.add_argument('--cache-ttl', type=float, default=168, dest='cache_ttl', help='Hours a cached SPARQL response stays valid.')
+    parser.add_argument('--cache-size', type=float, default=50, dest='cache_size', help='Maximum size of the SPARQL response cache in GB.')
+    parser.add_argument('--plan', default=False, dest='plan', action='store_true', help='Count every field concurrently, print the batch layout, expected writes and estimated runtime from the --metrics of earlier runs, and exit without loading.')
+    parser.add_argument('--parallel', default=False, dest='parallel', action='store_true', help='Run the batches in parallel on a pool of worker processes.')
+    parser.add_argument('--engine', choices=['process', 'async'], default='process', dest='engine', help='Run the updates in worker processes, or as coroutines in a single process (requires aiohttp and motor).')
+    parser.add_argument('--workers', type=int, default=mp.cpu_count(), dest='workers', help='Number of worker processes used with --parallel.')
+    parser.add_argument('--sparql-connections', type=int, default=0, dest='sparql_connections', help='Maximum concurrent SPARQL downloads with --parallel. Defaults to the number of workers.')
+    parser.add_argument('--mongo-connections', type=int, default=0, dest='mongo_connections', help='Maximum concurrent MongoDB bulk writes with --parallel. Defaults to the number of workers.')
+    parser.add_argument('--ledger', type=str, default="", dest='ledger', help='SQLite file recording the status, rows and timing of every job of the run, so it can be continued with --resume.')
+    parser.add_argument('--resume', default=False, dest='resume', action='store_true', help='Continue the run recorded in --ledger: skip its finished jobs and continue the others from their last completed page.')
+    parser.add_argument('--mongo-uri', type=str, default="mongodb://localhost:27017/", dest='mongo_uri', help='The MongoDB server holding db-name.')
+    parser.add_argument('--coordinator', default=False, dest='coordinator', action='store_true', help='Publish the jobs to the _tasks collection of db-name for --worker instances to run, and wait for them.')
+    parser.add_argument('--worker', default=False, dest='worker', action='store_true', help='Claim and run the jobs published by a --coordinator until none are left. Uses the settings of the coordinator.')
+    parser.add_argument('--lease', type=float, default=60, dest='lease', help='Seconds a --worker holds a job without a heartbeat before other workers may take it over.')
+    parser.add_argument('--index-profiles', default=False, dest='index_profiles', action='store_true', help='After a successful load, add the compound and prefix search indexes of the read side and report how they change representative lookups.')
+    parser.add_argument('--retries', type=int, default=2, dest='retries', help='Number of times a failed batch is retried with --parallel.')
+
+    args = parser.parse_args()
+    if args.rebuild and (args.incremental or args.field):
+        parser.error("--rebuild loads complete collections and cannot be combined with --incremental or --field.")
+    if args.rebuild and (args.wipe or args.drop):
+        parser.error("--rebuild keeps the live collections readable until the swap and cannot be combined with --wipe or --drop.")
+    if args.engine == "async" and (args.incremental or args.pagination == "offset"):
+        parser.error("The async engine pages by key and does not support --incremental or --pagination offset.")
+    if args.engine == "async":
+        unsupported = [option for option, dest in [("--cache", "cache_dir"), ("--metrics", "metrics_file"),
+                                                   ("--profile", "profile_dir"), ("--queue-depth", "queue_depth"),
+                                                   ("--http-retries", "http_retries"), ("--ledger", "ledger")]
+                       if getattr(args, dest) != parser.get_default(dest)]
+        if unsupported:
+            parser.error("The async engine downloads and writes through its own sessions and does not support " +
+                         ", ".join(unsupported) + ".")
+    if args.pagination is None:
+        args.pagination = "keyset" if args.engine == "async" else "offset"
+    if args.resume and (args.engine == "async" or args.drop or args.wipe):
+        parser.error("--resume continues the jobs of the process engine and cannot be combined with --engine async, --drop or --wipe.")
+    if (args.coordinator or args.worker) and (args.engine == "async" or args.coordinator == args.worker):
+        parser.error("Use either --coordinator or --worker, with the process engine.")
+    if args.resume and not args.coordinator and not args.ledger:
+        parser.error("--resume needs the --ledger of the run it continues.")
+    if args.resume and not args.coordinator and not os.path.exists(args.ledger):
+        parser.error("--resume needs the ledger of an earlier run, " + args.ledger + " does not exist.")
+
+    baseUrl = args.hostname + ":" + args.port
+    dbName = args.dbName
+    wipeData = args.wipe
+    query_batch_size = args.batchsize
+    parallel = args.parallel
+    dropDatabase = args.drop
+
+    headerText = """
+    %s          -------------------           METADATABASE UPDATER          -------------------
+    %s                Updater tool for downloading and caching the BioGateway metadatabase.    
+    %s                Parameters: <hostname:port> <db-name> (Optional)<datatype> (Optional)<fieldType>  
+    %s                Connecting to endpoint on:        %s
+    %s                Updating database:                %s
+    %s                Parallel:                         %s
+    %s          -------------------------------------------------------------------------------
+    """ % (timestamp(), timestamp(), timestamp(), timestamp(), baseUrl, timestamp(), dbName, timestamp(), parallel, timestamp())
+
+    print(headerText)
+
+    print(timestamp() + 'Loading data into ' + dbName + ' using port ' + baseUrl + '...')
+
+    if args.worker:
+        queue = TaskQueue(MongoClient(args.mongo_uri)[dbName], args.lease)
+        run = queue.run()
+        if run is None:
+            print(timestamp() + "No run has been published to " + dbName + " by a --coordinator.")
+            raise SystemExit(1)
+        # The degree tables published by the coordinator are downloaded next to those of the serial mode.
+        scoresFile = ""
+        if run.get("degrees"):
+            scoresFile = os.path.join(tempfile.gettempdir(), "degrees-" + dbName + "-" + run["degrees"])
+        context = replace(UpdateContext(**run["context"]), ledger="", scores_file=scoresFile, mongo_uri=args.mongo_uri)
+        targets = {(data_type_key(dataType), name): (dataType, target) for dataType, name, target in
+                   field_tasks(select_data_types(run["datatype"], run["field"]), run["combined"])}
+        run_worker(queue, context, targets, worker_name())
+        raise SystemExit(0)
+
+    dataTypes = select_data_types(args.datatype, args.field)
+
+    context = UpdateContext(args.hostname + ":" + args.port, args.dbName, args.wipe, args.batchsize, args.parallel, args.flushsize,
+                            args.workers, args.sparql_connections, args.mongo_connections, args.retries,
+                            args.incremental, args.rebuild, args.pagination,
+                            args.cache_dir, args.cache_ttl, args.cache_size, args.queue_depth,
+                            args.metrics_file, args.profile_dir, args.profiler, args.adaptive, args.batch_state,
+                            args.page_seconds, args.timeout, args.ledger, mongo_uri=args.mongo_uri,
+                            group_buffer=args.group_buffer, http_retries=args.http_retries)
+
+    if args.plan:
+        print_plan(plan_fields(field_tasks(dataTypes, args.combined), context), context)
+        raise SystemExit(0)
+
+    if dropDatabase:
+        print("Dropping database " + dbName + "and rebuilding indexes.")
+        drop_and_reset_database(dbName, args.mongo_uri)
+        print("Database " + dbName + " has been reset.")
+
+    print(timestamp() + "Updating:")
+    print(*dataTypes, sep="\n")
+
+
+    collectionNames = []
+    for dataType in dataTypes:
+        for collection in dataType.dbCollections:
+            if collection.name not in collectionNames:
+                collectionNames.append(collection.name)
+
+    if wipeData:
+        wipe_collections(dbName, collectionNames, args.mongo_uri)
+
+    # A resumed run keeps the shadow collections and seen marks of the run it continues.
+    if args.rebuild and not args.resume:
+        prepare_shadows(dbName, collectionNames, args.mongo_uri)
+
+    # Documents are only swept from collections whose labels are reloaded, since every entity has a label.
+    sweepCollections = []
+    seenCollections = []
+    if args.incremental:
+        seenCollections = collectionNames
+        for dataType in dataTypes:
+            for collection in dataType.dbCollections:
+                if dataType.labels and collection.name not in sweepCollections:
+                    sweepCollections.append(collection.name)
+        if not args.resume:
+            reset_seen(dbName, seenCollections, args.mongo_uri)
+
+    # With --coordinator the _tasks collection takes the place of the ledger.
+    ledger = Ledger(args.ledger) if args.ledger and not args.coordinator else None
+    if ledger and not args.resume:
+        ledger.reset()
+
+    tasks = field_tasks(dataTypes, args.combined)
+
+    if args.resume and ledger:
+        finished = [(dataType, name) for dataType, name, target in tasks if ledger.field_done(data_type_key(dataType), name)]
+        for dataType, name in finished:
+            print(timestamp() + "Skipping " + dataType.graph + " " + name + ", finished by the resumed run.")
+        tasks = [task for task in tasks if task[:2] not in finished]
+
+    # The relation counts behind the scores are fetched once and shared by the scores of every DataType. A
+    # --coordinator publishes them to its workers along with the tasks.
+    scored = [dataType for dataType, name, target in tasks if name == "scores"]
+    degreeTables = build_degree_tables(context, scored) if scored else ""
+    if not args.coordinator:
+        context = replace(context, scores_file=degreeTables)
+
+    failed = []
+    if args.engine == "async":
+        failed = run_async([(dataType, target) for dataType, name, target in tasks], context)
+    else:
+        jobs = []
+        if parallel or args.coordinator:
+            # The fields are counted concurrently and their jobs queued longest first.
+            plans = plan_fields(tasks, context)
+            print_plan(plans, context)
+            for plan in plans:
+                jobs.extend(startBatches(plan.dataType, plan.name, plan.target, context, plan.count, plan.seconds))
+            jobs.sort(key=lambda job: job.estimate, reverse=True)
+        else:
+            # A serial run goes through the same batches as a parallel one, in the order of the fields.
+            for dataType, name, target in tasks:
+                jobs.extend(startBatches(dataType, name, target, context))
+        if ledger:
+            for job in jobs:
+                ledger.plan(data_type_key(job.dataType), job.name, job.offset)
+        if args.resume and ledger:
+            jobs = resume_jobs(context, jobs)
+        if args.coordinator:
+            queue = TaskQueue(MongoClient(args.mongo_uri)[dbName], args.lease)
+            degrees = ""
+            if degreeTables:
+                degrees = queue.publish_tables(degreeTables, [data_type_key(dataType) for dataType in scored])
+            queue.publish({"context": asdict(context), "datatype": args.datatype, "field": args.field,
+                           "combined": args.combined, "degrees": degrees}, jobs, args.resume)
+            print(timestamp() + "Published " + str(len(jobs)) + " tasks, waiting for the workers...")
+            failed = queue.wait()
+        elif jobs and parallel:
+            failed = run_jobs(jobs, context)
+        elif jobs:
+            failed = run_serial(jobs, context)
+
+    # The seen marks are only dropped after a complete run. After failed batches they are kept for --resume,
+    # whose final sweep needs the marks of the jobs it does not rerun.
+    if seenCollections and failed:
+        print(timestamp() + "Not removing documents no longer in the source because some batches failed.")
+    elif seenCollections:
+        if sweepCollections:
+            sweep_removed(dbName, sweepCollections, args.mongo_uri)
+        reset_seen(dbName, seenCollections, args.mongo_uri)
+    if args.rebuild:
+        if failed:
+            print(timestamp() + "Not swapping in the rebuilt collections because some batches failed.")
+        else:
+            swap_shadows(dbName, collectionNames, args.mongo_uri)
+    if args.index_profiles and not failed:
+        build_index_profiles(dbName, collectionNames, args.mongo_uri, args.flushsize)
+    elif not failed:
+        # Collections with an index profile get the prefixes of the labels and synonyms this run loaded.
+        textCollections = []
+        for dataType, name, target in field_tasks(dataTypes, args.combined):
+            for collection in dataType.dbCollections:
+                if name in ["labels", "synonyms", "combined"] and collection.name not in textCollections:
+                    textCollections.append(collection.name)
+        refresh_prefixes(dbName, textCollections, args.mongo_uri, args.flushsize)
+
+    print_summary(args.metrics_file, startTime)
+    if ledger:
+        print(timestamp() + "Ledger " + args.ledger + ": " + ", ".join(
+            str(count) + " " + status for status, count in sorted(ledger.summary().items())))
+        ledger.close()
 
     durationTime = time.time() - startTime
+    if failed:
+        print(timestamp() + str(len(failed)) + " batches failed. Updates finished in: " + time.strftime("%H:%M:%S.", time.gmtime(durationTime)))
+        raise SystemExit(1)
     print(timestamp() + "All updates completed in: " + time.strftime("%H:%M:%S.", time.gmtime(durationTime)))
@@ -0,0 +1,150 @@
+import cProfile
+import json
+import os
+import time
+from contextlib import contextmanager
+
+from scheduler import timestamp
+
+
+def latency_bucket(seconds):
+    # Write latencies are counted in power-of-two millisecond buckets: 1, 2, 4, ... ms.
+    bucket = 1
+    milliseconds = seconds * 1000
+    while bucket < milliseconds:
+        bucket *= 2
+    return bucket
+
+
+class BatchMetrics:
+    # Measurements of one batch (a keyset page, an offset batch or a count query) of one (DataType, field).
+    def __init__(self, dataType, field, batch, writer=None):
+        self.dataType = dataType
+        self.field = field
+        self.batch = batch
+        self.startTime = time.time()
+        self.rows = 0
+        self.bytes = 0
+        self.timeToFirstByte = 0.0
+        self.network = 0.0
+        self.parse = 0.0
+        self.write = 0.0
+        self.writeLatencies = {}
+        self.dataWait = 0.0
+        self.writerWait = -writer.blocked_time() if writer else 0.0
+
+    def add_reader(self, reader):
+        self.bytes += reader.bytes
+        self.network += reader.networkTime
+        self.dataWait += reader.waitTime
+
+    def finish(self, writer=None):
+        # Parse time is the batch wall time not spent waiting for the response or for the writer.
+        if writer:
+            self.writerWait += writer.blocked_time()
+        elapsed = time.time() - self.startTime
+        self.parse = max(elapsed - self.timeToFirstByte - self.dataWait - self.writerWait, 0)
+
+    def add_write(self, seconds):
+        bucket = latency_bucket(seconds)
+        self.writeLatencies[bucket] = self.writeLatencies.get(bucket, 0) + 1
+        self.write += seconds
+
+    def record(self):
+        seconds = time.time() - self.startTime
+        return {
+            "time": time.time(),
+            "pid": os.getpid(),
+            "dataType": self.dataType,
+            "field": self.field,
+            "batch": self.batch,
+            "rows": self.rows,
+            "bytes": self.bytes,
+            "seconds": round(seconds, 3),
+            "rowsPerSecond": round(self.rows / seconds, 1) if seconds else 0,
+            "bytesPerSecond": round(self.bytes / seconds, 1) if seconds else 0,
+            "timeToFirstByte": round(self.timeToFirstByte, 3),
+            "network": round(self.network, 3),
+            "parse": round(self.parse, 3),
+            "write": round(self.write, 3),
+            "writeLatencyMs": self.writeLatencies}
+
+
+def export(context, metrics):
+    if not context.metrics_file:
+        return
+    line = json.dumps(metrics.record()) + "\n"
+    # Small appends to a file opened with O_APPEND are not interleaved between the worker processes.
+    with open(context.metrics_file, "a") as file:
+        file.write(line)
+
+
+def latency_percentile(histogram, percentile):
+    total = sum(histogram.values())
+    seen = 0
+    for bucket in sorted(histogram):
+        seen += histogram[bucket]
+        if seen >= total * percentile:
+            return bucket
+    return 0
+
+
+def print_summary(path, since=0):
+    if not path or not os.path.exists(path):
+        return
+    totals = {}
+    with open(path) as file:
+        for line in file:
+            record = json.loads(line)
+            if record["time"] < since:
+                continue
+            key = (record["dataType"], record["field"])
+            total = totals.setdefault(key, {"batches": 0, "rows": 0, "bytes": 0, "seconds": 0.0, "ttfb": 0.0,
+                                            "network": 0.0, "parse": 0.0, "write": 0.0, "latencies": {}})
+            total["batches"] += 1
+            for name in ["rows", "bytes", "seconds", "network", "parse", "write"]:
+                total[name] += record[name]
+            total["ttfb"] += record["timeToFirstByte"]
+            for bucket, count in record["writeLatencyMs"].items():
+                total["latencies"][int(bucket)] = total["latencies"].get(int(bucket), 0) + count
+
+    print(timestamp() + "Metrics summary (" + path + "):")
+    print("%-14s %-18s %8s %12s %10s %10s %10s %8s %8s %8s %8s %8s %8s" % (
+        "data type", "field", "batches", "rows", "MB", "seconds", "rows/s", "ttfb s", "net s", "parse s",
+        "write s", "p50 ms", "p95 ms"))
+    for (dataType, field), total in sorted(totals.items()):
+        print("%-14s %-18s %8d %12d %10.1f %10.1f %10.0f %8.2f %8.1f %8.1f %8.1f %8d %8d" % (
+            dataType, field, total["batches"], total["rows"], total["bytes"] / 1e6, total["seconds"],
+            total["rows"] / total["seconds"] if total["seconds"] else 0, total["ttfb"] / total["batches"],
+            total["network"], total["parse"], total["write"], latency_percentile(total["latencies"], 0.5),
+            latency_percentile(total["latencies"], 0.95)))
+
+
+@contextmanager
+def profiled(context, label):
+    # Profiles one worker job when --profile is set, writing a .prof (cProfile) or .html (pyinstrument) file.
+    if not context.profile_dir:
+        yield
+        return
+    os.makedirs(context.profile_dir, exist_ok=True)
+    path = os.path.join(context.profile_dir, label.replace(" ", "_") + "-" + str(os.getpid()) + "-" +
+                        str(int(time.time())))
+    if context.profiler == "pyinstrument":
+        from pyinstrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(path + ".html", "w") as file:
+                file.write(profiler.output_html())
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path + ".prof")
+
@@ -0,0 +1,122 @@
+import queue
+import threading
+import time
+from contextlib import ExitStack
+
+from scheduler import timestamp
+
+
+class ChunkReader:
+    # Network stage of a worker: a thread reads the response into a bounded queue of chunks while the parser
+    # consumes them, so the socket keeps receiving while rows are parsed and written. slot is the download slot
+    # the response was opened under; it is released as soon as the thread has read the whole body.
+    def __init__(self, stream, depth, chunk_size=1 << 20, slot=None):
+        self.stream = stream
+        self.slot = slot or ExitStack()
+        self.chunk_size = chunk_size
+        self.queue = queue.Queue(depth)
+        self.stopped = False
+        self.finished = False
+        self.networkTime = 0.0
+        self.blockedTime = 0.0
+        self.waitTime = 0.0
+        self.bytes = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            while not self.stopped:
+                startTime = time.time()
+                chunk = self.stream.read(self.chunk_size)
+                self.networkTime += time.time() - startTime
+                self.bytes += len(chunk)
+                if not chunk:
+                    self.slot.close()
+                self.put(chunk)
+                if not chunk:
+                    break
+        except Exception as error:
+            self.put(error)
+        finally:
+            self.slot.close()
+
+    def put(self, item):
+        startTime = time.time()
+        while not self.stopped:
+            try:
+                self.queue.put(item, timeout=0.5)
+                break
+            except queue.Full:
+                continue
+        self.blockedTime += time.time() - startTime
+
+    def read(self, size=-1):
+        if self.finished:
+            return b""
+        startTime = time.time()
+        item = self.queue.get()
+        self.waitTime += time.time() - startTime
+        if isinstance(item, Exception):
+            self.finished = True
+            raise item
+        if not item:
+            self.finished = True
+        return item
+
+    def close(self):
+        self.stopped = True
+        self.thread.join()
+        self.stream.close()
+
+
+class MeteredStream:
+    # Sequential stand-in for ChunkReader that only measures the reads and releases slot at the end of the body.
+    def __init__(self, stream, slot=None):
+        self.stream = stream
+        self.slot = slot or ExitStack()
+        self.networkTime = 0.0
+        self.blockedTime = 0.0
+        self.waitTime = 0.0
+        self.bytes = 0
+
+    def read(self, size=-1):
+        startTime = time.time()
+        chunk = self.stream.read(size)
+        duration = time.time() - startTime
+        self.networkTime += duration
+        self.waitTime += duration
+        self.bytes += len(chunk)
+        if not chunk:
+            self.slot.close()
+        return chunk
+
+    def close(self):
+        self.slot.close()
+        self.stream.close()
+
+
+class StageTimes:
+    def __init__(self):
+        self.network = 0.0
+        self.networkBlocked = 0.0
+        self.parserWaiting = 0.0
+        self.bytes = 0
+
+    def add_reader(self, reader):
+        self.network += reader.networkTime
+        self.networkBlocked += reader.blockedTime
+        self.parserWaiting += reader.waitTime
+        self.bytes += reader.bytes
+
+
+def report_stages(label, elapsed, stages, writer):
+    # Parse time is what is left of the worker's wall time after waiting for chunks and for the writer.
+    parse = max(elapsed - stages.parserWaiting - writer.blocked_time(), 0)
+    times = {"network": stages.network, "parse": parse, "write": writer.writeTime}
+    bottleneck = max(times, key=times.get)
+    print(timestamp() + "Stages for " + label + ": network " + str(round(stages.network, 1)) + "s (" +
+          str(round(stages.networkBlocked, 1)) + "s blocked on parser), parse " + str(round(parse, 1)) +
+          "s (" + str(round(stages.parserWaiting, 1)) + "s waiting for data, " + str(round(writer.blocked_time(), 1)) +
+          "s waiting for writes), write " + str(round(writer.writeTime, 1)) + "s. Bottleneck: " + bottleneck)
+
@@ -0,0 +1,110 @@
+import heapq
+import json
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from adaptive import learned_size
+from scheduler import data_type_key, keyset_paged, timestamp
+
+# Rows per second assumed for fields that no earlier run has recorded in the --metrics file.
+DEFAULT_RATE = 10000
+
+
+class FieldPlan:
+    def __init__(self, dataType, name, target, count):
+        self.dataType = dataType
+        self.name = name
+        self.target = target
+        self.count = count
+        self.rate = 0.0
+        self.estimated = False
+        self.batchSize = 0
+        self.batches = 0
+        self.documents = 0
+        self.seconds = 0.0
+
+
+def throughput_history(path):
+    # Rows per second of every (DataType, field) over all batches recorded in the metrics file.
+    totals = {}
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        for line in file:
+            record = json.loads(line)
+            if record["field"].endswith(" count"):
+                continue
+            total = totals.setdefault((record["dataType"], record["field"]), [0, 0.0])
+            total[0] += record["rows"]
+            total[1] += record["seconds"]
+    return {key: rows / seconds for key, (rows, seconds) in totals.items() if rows and seconds}
+
+
+def count_fields(tasks, context):
+    # The COUNT queries run concurrently, bounded like the downloads. With --cache their responses are
+    # cached with the rest, so a plan followed by a run only counts once.
+    with ThreadPoolExecutor(context.sparql_connections or context.workers) as executor:
+        futures = [executor.submit(target, dataType, context, justCount=True) for dataType, name, target in tasks]
+        return [future.result() for future in futures]
+
+
+def plan_fields(tasks, context):
+    startTime = time.time()
+    print(timestamp() + "Counting " + str(len(tasks)) + " fields...")
+    counts = count_fields(tasks, context)
+    history = throughput_history(context.metrics_file)
+    defaultRate = sum(history.values()) / len(history) if history else DEFAULT_RATE
+    plans = []
+    for (dataType, name, target), count in zip(tasks, counts):
+        plan = FieldPlan(dataType, name, target, count)
+        key = data_type_key(dataType)
+        plan.rate = history.get((key, name), 0.0)
+        if not plan.rate:
+            plan.rate = defaultRate
+            plan.estimated = True
+        plan.batchSize = learned_size(context, key + "/" + name)
+        plan.batches = math.ceil(count / plan.batchSize) if count else 0
+        # An upper bound: every row becomes a document in each collection of the DataType.
+        plan.documents = count * len(dataType.dbCollections)
+        plan.seconds = count / plan.rate
+        plans.append(plan)
+    print(timestamp() + "Counted in " + str(round(time.time() - startTime, 1)) + "s")
+    return sorted(plans, key=lambda plan: plan.seconds, reverse=True)
+
+
+def makespan(seconds, workers):
+    # Finishing time when the jobs are started longest first, each on the first worker to become free.
+    finishTimes = [0.0] * max(workers, 1)
+    for jobSeconds in sorted(seconds, reverse=True):
+        heapq.heapreplace(finishTimes, finishTimes[0] + jobSeconds)
+    return max(finishTimes)
+
+
+def print_plan(plans, context):
+    print(timestamp() + "Plan (longest first, rows/s from " + (context.metrics_file or "no metrics file") +
+          ", * marks fields without history):")
+    print("%-14s %-18s %12s %10s %8s %14s %12s %10s" % (
+        "data type", "field", "rows", "batch", "batches", "max documents", "rows/s", "estimate"))
+    for plan in plans:
+        print("%-14s %-18s %12d %10d %8d %14d %11.0f%s %10s" % (
+            data_type_key(plan.dataType), plan.name, plan.count, plan.batchSize, plan.batches, plan.documents,
+            plan.rate, "*" if plan.estimated else " ", duration(plan.seconds)))
+    jobSeconds = []
+    for plan in plans:
+        if keyset_paged(context, plan.name):
+            jobSeconds.append(plan.seconds)
+        elif plan.batches:
+            jobSeconds.extend([plan.seconds / plan.batches] * plan.batches)
+    serial = sum(jobSeconds)
+    print(timestamp() + "Estimated runtime: " + duration(serial) + " serially, " +
+          duration(makespan(jobSeconds, context.workers)) + " on " +
+          str(context.workers) + " workers. At most " + str(sum(plan.documents for plan in plans)) +
+          " document writes.")
+
+
+def duration(seconds):
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
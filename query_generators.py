@@ -27,58 +27,96 @@ def generate_name_label_query(graph, constraint, count=False):
     """ % (select, graph, constraint)
     return query
 
-def generate_fromScore_query(graph, constraint):
+multi_value_separator = "\u001f"
+
+def generate_combined_query(graph, constraint, fields):
+    # Fetches every enabled field of a DataType in one pass: one row per ?uri, with OPTIONAL blocks for the
+    # single valued fields. Each multi valued field is concatenated per ?uri in its own grouped subquery, so
+    # the endpoint joins one row per field instead of the cross product of all their values.
+    select = ["?uri"]
+    patterns = []
+    subqueries = []
+    if "labels" in fields:
+        select.append("(SAMPLE(?label) AS ?prefLabel) (SAMPLE(?labelDefinition) AS ?definition)")
+        patterns.append("OPTIONAL { ?uri skos:definition ?labelDefinition . }")
+    if "synonyms" in fields:
+        select.append("(SAMPLE(?synonymList) AS ?synonyms)")
+        subqueries.append(generate_concat_subquery(graph, constraint, "skos:altLabel", "?synonymList"))
+    if "taxon" in fields:
+        select.append("(SAMPLE(?taxonValue) AS ?taxon)")
+        patterns.append("OPTIONAL { ?uri <http://purl.obolibrary.org/obo/BFO_0000052> ?taxonValue . }")
+    if "instances" in fields:
+        select.append("(SAMPLE(?instanceList) AS ?instances)")
+        subqueries.append(generate_concat_subquery(graph, constraint, "<http://schema.org/evidenceOrigin>",
+                                                   "?instanceList"))
+    if "annotationScore" in fields:
+        select.append("(SAMPLE(?annotationScoreValue) AS ?annotationScore)")
+        patterns.append("OPTIONAL { ?uri <http://schema.org/evidenceLevel> ?annotationScoreValue . }")
     query = """
-    SELECT DISTINCT ?uri COUNT(?node) as ?relationCount
+    SELECT %s
     WHERE {
     GRAPH <http://rdf.biogateway.eu/graph/%s> {
     ?uri skos:prefLabel|rdfs:label ?label .
     %s
+    %s
     }
-    GRAPH ?graph {
-    ?uri ?relation ?node .
-    }
+    %s
     }
-    """ % (graph, constraint)
+    GROUP BY ?uri
+    """ % (" ".join(select), graph, constraint, "\n    ".join(patterns), "\n    ".join(subqueries))
     return query
 
-def generate_toScore_query(graph, constraint):
-    query = """
-    SELECT DISTINCT ?uri COUNT(?node) as ?relationCount
+def generate_concat_subquery(graph, constraint, relationType, variable):
+    # The values of one multi valued field of every ?uri of the DataType, joined by multi_value_separator.
+    subquery = """OPTIONAL {
+    SELECT ?uri (GROUP_CONCAT(DISTINCT ?value; separator="\\u001F") AS %s)
     WHERE {
     GRAPH <http://rdf.biogateway.eu/graph/%s> {
-    ?uri skos:prefLabel|rdfs:label ?label .
+    ?uri %s ?value .
     %s
     }
+    }
+    GROUP BY ?uri
+    }""" % (variable, graph, relationType, constraint)
+    return subquery
+
+def generate_graphs_query():
+    query = """
+    SELECT DISTINCT ?graph
+    WHERE {
     GRAPH ?graph {
-    ?node ?relation ?uri .
+    ?subject ?relation ?object .
+    }
+    }
+    """
+    return query
+
+def generate_degree_query(graph, inbound):
+    # The number of triples of one source graph with each ?uri as their object (inbound) or subject (outbound).
+    pattern = "?node ?relation ?uri ." if inbound else "?uri ?relation ?node ."
+    query = """
+    SELECT ?uri (COUNT(?node) AS ?degree)
+    WHERE {
+    GRAPH <%s> {
+    %s
+    FILTER(isIRI(?uri))
     }
     }
-    """ % (graph, constraint)
+    GROUP BY ?uri
+    """ % (graph, pattern)
     return query
 
-def generate_scores_query(graph, constraint):
+def generate_scored_uris_query(graph, constraint, count=False):
+    select = "COUNT(?uri)" if count else "DISTINCT ?uri"
     query = """
-    SELECT DISTINCT ?uri ?fromScore ?toScore
+    SELECT %s
     WHERE {
     GRAPH <http://rdf.biogateway.eu/graph/%s> {
     ?uri skos:prefLabel|rdfs:label ?label .
     %s
     }
-	{
-	SELECT ?uri COUNT(?fromNode) as ?fromScore
-	WHERE {
-    GRAPH ?fromGraph {
-    ?fromNode ?relation ?uri .
-    }}}
-	{
-	SELECT ?uri COUNT(?toNode) as ?toScore
-	WHERE {
-    GRAPH ?toGraph {
-    ?uri ?relation ?toNode .
-    }}}
-	}
-    """ % (graph, constraint)
+    }
+    """ % (select, graph, constraint)
     return query
 
 def generate_GO_namespace_constraint(namespace):
@@ -95,9 +133,28 @@ def generate_count_query(query):
     """ % (query)
     return count_query
 
+def sparql_string(value):
+    return "\"" + value.replace("\\", "\\\\").replace("\"", "\\\"") + "\""
+
+def generate_keyset_query(query, after=None, limit=None):
+    # Pages through the results in ?uri order. Instead of skipping OFFSET rows, each page continues after the
+    # last uri of the previous one, so the endpoint can start every page at its key.
+    if after:
+        end = query.rfind("}")
+        query = query[:end] + "\n    FILTER(STR(?uri) > %s)\n    " % sparql_string(after) + query[end:]
+    query += "\nORDER BY STR(?uri)"
+    if limit:
+        query += "\nLIMIT " + str(limit)
+    return query
+
+def generate_ordered_query(query):
+    # Orders LIMIT/OFFSET batches by uri, so the rows of one uri come together and the batches do not
+    # depend on the order the endpoint happens to return.
+    return query + "\nORDER BY ?uri"
+
 def generateUrl(baseUrl, query, limit=None, offset=None):
     if limit:
         query += "\nLIMIT " + str(limit)
     if offset:
-        query += "\nOFFSET " + str(limit)
+        query += "\nOFFSET " + str(offset)
     return "http://" + baseUrl + "/sparql/" + "?query=" + urllib.parse.quote(query) + "&format=text%2Ftab-separated-values&timeout=0"
\ No newline at end of file
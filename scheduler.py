@@ -0,0 +1,129 @@
+import time
+import multiprocessing as mp
+from contextlib import nullcontext
+from dataclasses import dataclass, replace
+
+sparqlSlots = None
+mongoSlots = None
+
+
+# Fields with a value per row, written with $addToSet, whose rows are grouped per document in offset batches.
+multi_valued_fields = ["synonyms", "instances"]
+
+
+def keyset_paged(context, name):
+    # Incremental runs page the multi-valued fields by key, which keeps all rows of a document together, so
+    # their arrays can be replaced as a whole instead of only ever growing.
+    return context.pagination == "keyset" or (context.incremental and name in multi_valued_fields)
+
+
+def data_type_key(dataType):
+    # The go graph backs three DataTypes, so they are told apart by their first collection.
+    return dataType.dbCollections[0].name
+
+
+class BatchError(Exception):
+    # Raised by keyset paged workers; after is the last uri that was completely written.
+    def __init__(self, message, after=None):
+        super().__init__(message, after)
+        self.after = after
+
+
+@dataclass
+class Job:
+    dataType: object
+    name: str
+    target: object
+    offset: int = 0
+    count: int = 0
+    attempts: int = 0
+    after: str = None
+    size: int = 0
+    estimate: float = 0.0
+
+    def describe(self):
+        if self.after:
+            return self.dataType.graph + " " + self.name + " after: " + self.after
+        return self.dataType.graph + " " + self.name + " offset: " + str(self.offset)
+
+
+def init_worker(sparql, mongo):
+    global sparqlSlots, mongoSlots
+    sparqlSlots = sparql
+    mongoSlots = mongo
+
+
+def sparql_slot():
+    return sparqlSlots or nullcontext()
+
+
+def mongo_slot():
+    return mongoSlots or nullcontext()
+
+
+def run_job(job, context):
+    # Offset batches are laid out with the batch size learned for their field, so they run with that size.
+    if job.size:
+        context = replace(context, batch_size=job.size)
+    job.target(job.dataType, context, job.offset, job.count, after=job.after)
+
+
+def retry_job(job, error, context):
+    # Records a failed attempt of job and tells whether it has retries left.
+    job.attempts += 1
+    if isinstance(error, BatchError) and error.after:
+        job.after = error.after
+    print(timestamp() + "Job failed (attempt " + str(job.attempts) + "): " + job.describe() + ": " + repr(error))
+    return job.attempts <= context.retries
+
+
+def run_serial(jobs, context):
+    # Runs the jobs one after another in this process, with the same retries as run_jobs.
+    failed = []
+    print(timestamp() + "Running " + str(len(jobs)) + " jobs one after another...")
+    for job in jobs:
+        while True:
+            try:
+                run_job(job, context)
+                break
+            except Exception as error:
+                if not retry_job(job, error, context):
+                    failed.append(job)
+                    break
+            time.sleep(min(2 ** job.attempts, 60))
+
+    for job in failed:
+        print(timestamp() + "Giving up on " + job.describe())
+    return failed
+
+
+def run_jobs(jobs, context):
+    # Runs the jobs on a bounded pool of worker processes. The SPARQL and Mongo sides get their own
+    # semaphores so the endpoint and the database can be throttled independently of the pool size.
+    # Failed jobs are put back on the queue until they have used up their retries.
+    sparql = mp.BoundedSemaphore(context.sparql_connections or context.workers)
+    mongo = mp.BoundedSemaphore(context.mongo_connections or context.workers)
+    failed = []
+    print(timestamp() + "Running " + str(len(jobs)) + " jobs on " + str(context.workers) + " workers...")
+    with mp.Pool(context.workers, initializer=init_worker, initargs=(sparql, mongo)) as pool:
+        pending = [(job, pool.apply_async(run_job, (job, context))) for job in jobs]
+        while pending:
+            job, result = pending.pop(0)
+            try:
+                result.get()
+                continue
+            except Exception as error:
+                retry = retry_job(job, error, context)
+            if retry:
+                time.sleep(min(2 ** job.attempts, 60))
+                pending.append((job, pool.apply_async(run_job, (job, context))))
+            else:
+                failed.append(job)
+
+    for job in failed:
+        print(timestamp() + "Giving up on " + job.describe())
+    return failed
+
+
+def timestamp():
+    return "[" + time.strftime("%H:%M:%S", time.localtime()) + "] "
@@ -0,0 +1,73 @@
+import fcntl
+import os
+import pickle
+from array import array
+
+# The inbound and outbound triple counts of the uris one DataType scores, summed over the source graphs. Each
+# DataType gets its own table, so a worker only loads the uris of the scores jobs it runs. Uris are numbered in
+# the order they are first seen and the counts are kept in two integer arrays indexed by that number, so the
+# table costs the uri strings plus 16 bytes per uri.
+
+_tables = {}
+
+
+def table_path(prefix, key):
+    return prefix + "-" + key + ".pickle"
+
+
+def write_table_file(path, write, overwrite=True):
+    # Writes path through a temporary file under a lock, so processes loading a table never read it half
+    # written. Without overwrite an existing file is kept, and only the first of several processes writes it.
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not overwrite and os.path.exists(path):
+            return
+        temporaryPath = path + "." + str(os.getpid()) + ".tmp"
+        with open(temporaryPath, "wb") as file:
+            write(file)
+        os.replace(temporaryPath, path)
+
+
+class DegreeTable:
+    def __init__(self):
+        self.index = {}
+        self.inbound = array("q")
+        self.outbound = array("q")
+
+    def __len__(self):
+        return len(self.index)
+
+    def add(self, uri, inbound=0, outbound=0):
+        position = self.index.get(uri)
+        if position is None:
+            position = len(self.index)
+            self.index[uri] = position
+            self.inbound.append(0)
+            self.outbound.append(0)
+        self.inbound[position] += inbound
+        self.outbound[position] += outbound
+
+    def degrees(self, uri):
+        position = self.index.get(uri)
+        if position is None:
+            return 0, 0
+        return self.inbound[position], self.outbound[position]
+
+    def save(self, path):
+        write_table_file(path, lambda file: pickle.dump((self.index, self.inbound, self.outbound), file,
+                                                        protocol=pickle.HIGHEST_PROTOCOL))
+        _tables[path] = self
+
+    @staticmethod
+    def loaded(path):
+        return path in _tables
+
+    @classmethod
+    def load(cls, path):
+        # Every worker process reads the table once and keeps it for the rest of its jobs.
+        if path not in _tables:
+            table = cls()
+            with open(path, "rb") as file:
+                table.index, table.inbound, table.outbound = pickle.load(file)
+            _tables[path] = table
+        return _tables[path]
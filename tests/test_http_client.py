@@ -0,0 +1,112 @@
+import gzip
+import http.server
+import threading
+import unittest
+import zlib
+from unittest import mock
+
+import http_client
+
+# http_client against a local HTTP/1.1 server that keeps connections alive and compresses its responses.
+
+BODY = b"".join(b"<http://rdf.biogateway.eu/prot/E%08d>\t\"label %d\"\n" % (i, i) for i in range(50000))
+
+
+def raw_deflate(data):
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class CompressingHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path == "/flaky" and self.server.requests.count("/flaky") == 1:
+            self.reply(503, b"busy", None)
+        elif self.path == "/raw-deflate":
+            self.reply(200, raw_deflate(BODY), "deflate")
+        elif self.path == "/deflate":
+            self.reply(200, zlib.compress(BODY), "deflate")
+        else:
+            self.reply(200, gzip.compress(BODY), "gzip")
+
+    def reply(self, status, body, encoding):
+        self.send_response(status)
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CompressingServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients that close a connection in the middle of a response are part of the tests.
+        pass
+
+
+class HttpClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = CompressingServer(("127.0.0.1", 0), CompressingHandler)
+        self.server.connections = 0
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.key = ("127.0.0.1", self.server.server_address[1])
+        http_client.idleConnections.clear()
+
+    def tearDown(self):
+        for connection in http_client.idleConnections.pop(self.key, []):
+            connection.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def url(self, path):
+        return "http://127.0.0.1:%d%s" % (self.key[1], path)
+
+    def test_gzip(self):
+        self.assertEqual(http_client.request(self.url("/gzip")).read(), BODY)
+
+    def test_zlib_deflate(self):
+        self.assertEqual(http_client.request(self.url("/deflate")).read(), BODY)
+
+    def test_raw_deflate_fallback(self):
+        response = http_client.request(self.url("/raw-deflate"))
+        chunks = iter(lambda: response.read(4096), b"")
+        self.assertEqual(b"".join(chunks), BODY)
+
+    def test_full_read_returns_connection(self):
+        response = http_client.request(self.url("/gzip"))
+        response.read()
+        self.assertEqual(http_client.idleConnections[self.key], [response.connection])
+        self.assertEqual(http_client.request(self.url("/gzip")).read(), BODY)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_partial_read_closes_connection(self):
+        response = http_client.request(self.url("/gzip"))
+        self.assertEqual(response.read(100), BODY[:100])
+        response.close()
+        self.assertIsNone(response.connection.sock)
+        self.assertFalse(http_client.idleConnections.get(self.key))
+        self.assertEqual(http_client.request(self.url("/gzip")).read(), BODY)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_retry_on_server_error(self):
+        with mock.patch.object(http_client.time, "sleep") as sleep:
+            response = http_client.request(self.url("/flaky"), retries=2)
+        self.assertEqual(response.read(), BODY)
+        self.assertEqual(self.server.requests, ["/flaky", "/flaky"])
+        sleep.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
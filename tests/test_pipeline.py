@@ -0,0 +1,46 @@
+import io
+import threading
+import unittest
+
+from pipeline import ChunkReader, MeteredStream
+
+# The download slot a response was opened under is released once its body has been read, before the parser
+# is done with the rows.
+
+
+class Slot:
+    def __init__(self):
+        self.released = threading.Event()
+
+    def close(self):
+        self.released.set()
+
+
+class PipelineTest(unittest.TestCase):
+    def test_metered_stream_releases_slot_at_end_of_body(self):
+        slot = Slot()
+        stream = MeteredStream(io.BytesIO(b"a\tb\n"), slot)
+        self.assertEqual(stream.read(2), b"a\t")
+        self.assertFalse(slot.released.is_set())
+        self.assertEqual(stream.read(10), b"b\n")
+        self.assertEqual(stream.read(10), b"")
+        self.assertTrue(slot.released.is_set())
+        stream.close()
+
+    def test_chunk_reader_releases_slot_before_chunks_are_consumed(self):
+        slot = Slot()
+        reader = ChunkReader(io.BytesIO(b"x" * 10), 4, chunk_size=4, slot=slot)
+        self.assertTrue(slot.released.wait(5))
+        self.assertEqual(b"".join(iter(reader.read, b"")), b"x" * 10)
+        reader.close()
+
+    def test_closing_early_releases_slot(self):
+        slot = Slot()
+        stream = MeteredStream(io.BytesIO(b"a\tb\n"), slot)
+        stream.read(1)
+        stream.close()
+        self.assertTrue(slot.released.is_set())
+
+
+if __name__ == '__main__':
+    unittest.main()
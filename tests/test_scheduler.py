@@ -0,0 +1,64 @@
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import scheduler
+from main import DataType, DatabaseCollection, UpdateContext
+from scheduler import BatchError, run_serial
+from updaters import startBatches
+
+# The serial path with the default offset pagination: every row of a field is covered by one batch.
+
+
+class Field:
+    # Stands in for an updater over rows 0..count-1 and records the rows it was asked to load.
+    def __init__(self, count, failures=0):
+        self.count = count
+        self.failures = failures
+        self.loaded = []
+
+    def __call__(self, dataType, context, offset=0, count=0, justCount=False, after=None):
+        if justCount:
+            return self.count
+        if self.failures:
+            self.failures -= 1
+            raise BatchError("endpoint went away")
+        self.loaded.extend(range(offset, min(offset + context.batch_size, count)))
+
+
+def data_type():
+    return DataType("omim", [DatabaseCollection("omim")], "", True, True)
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.context = UpdateContext("localhost:0", "test", False, 250, False)
+
+    def test_serial_offset_batches_cover_the_field(self):
+        field = Field(900)
+        jobs = startBatches(data_type(), "labels", field, self.context)
+        self.assertEqual([job.offset for job in jobs], [0, 250, 500, 750])
+        self.assertEqual(run_serial(jobs, self.context), [])
+        self.assertEqual(field.loaded, list(range(900)))
+
+    def test_serial_jobs_are_retried(self):
+        field = Field(300, failures=2)
+        with mock.patch.object(scheduler.time, "sleep"):
+            failed = run_serial(startBatches(data_type(), "labels", field, self.context), self.context)
+        self.assertEqual(failed, [])
+        self.assertEqual(field.loaded, list(range(300)))
+
+    def test_serial_jobs_give_up_after_their_retries(self):
+        field = Field(300, failures=10)
+        with mock.patch.object(scheduler.time, "sleep"):
+            failed = run_serial(startBatches(data_type(), "labels", field, self.context), self.context)
+        self.assertEqual([(job.offset, job.attempts) for job in failed], [(0, 3), (250, 3)])
+
+    def test_incremental_runs_page_multi_valued_fields_by_key(self):
+        context = SimpleNamespace(pagination="offset", incremental=True)
+        self.assertTrue(scheduler.keyset_paged(context, "synonyms"))
+        self.assertFalse(scheduler.keyset_paged(context, "labels"))
+
+
+if __name__ == '__main__':
+    unittest.main()
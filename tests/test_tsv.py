@@ -0,0 +1,101 @@
+import io
+import unittest
+
+from updaters import TsvRows, XSD, parse_tsv_cell, read_tsv_rows
+
+# The SPARQL TSV reader: every cell type, and responses cut into chunks that split cells, escapes, multibyte
+# characters and \r\n line ends.
+
+HEADER = b"?uri\t?value\r\n"
+
+CHUNK_SIZES = [1, 2, 3, 7, 64, 1 << 20]
+
+
+def read(body, chunk_size=1 << 20):
+    return list(read_tsv_rows(io.BytesIO(body), chunk_size))
+
+
+class TsvCellTest(unittest.TestCase):
+    def test_escapes(self):
+        self.assertEqual(parse_tsv_cell(r'"a\tb\nc\rd\\e\"f\'g"'), "a\tb\nc\rd\\e\"f'g")
+        self.assertEqual(parse_tsv_cell(r'"café \U0001F600"'), "café \U0001F600")
+        self.assertEqual(parse_tsv_cell(r'"ends with a backslash \\"'), "ends with a backslash \\")
+
+    def test_language_tags(self):
+        self.assertEqual(parse_tsv_cell('"colour"@en-GB'), "colour")
+        self.assertEqual(parse_tsv_cell(r'"say \"hi\""@en'), 'say "hi"')
+
+    def test_datatypes(self):
+        self.assertEqual(parse_tsv_cell('"42"^^<' + XSD + 'integer>'), 42)
+        self.assertEqual(parse_tsv_cell('"7"^^<' + XSD + 'unsignedShort>'), 7)
+        self.assertEqual(parse_tsv_cell('"2.5"^^<' + XSD + 'decimal>'), 2.5)
+        self.assertEqual(parse_tsv_cell('"1E3"^^<' + XSD + 'double>'), 1000.0)
+        self.assertEqual(parse_tsv_cell('"42"^^<' + XSD + 'string>'), "42")
+        self.assertEqual(parse_tsv_cell('"2020-01-01"^^<' + XSD + 'date>'), "2020-01-01")
+
+    def test_iris_and_other_cells(self):
+        self.assertEqual(parse_tsv_cell("<http://rdf.biogateway.eu/prot/P1>"), "http://rdf.biogateway.eu/prot/P1")
+        self.assertEqual(parse_tsv_cell("_:b0"), "_:b0")
+        self.assertEqual(parse_tsv_cell("12"), "12")
+        self.assertEqual(parse_tsv_cell(""), "")
+
+
+class TsvRowsTest(unittest.TestCase):
+    def assertRowsInEveryChunking(self, body, expected):
+        for chunk_size in CHUNK_SIZES:
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(read(body, chunk_size), expected)
+
+    def test_plain_literals(self):
+        body = HEADER + b'"P1"\t"one"\r\n"P2"\t"two"\r\n'
+        self.assertRowsInEveryChunking(body, [["P1", "one"], ["P2", "two"]])
+
+    def test_escapes_between_plain_lines(self):
+        body = (HEADER + b'"P1"\t"one"\n"P2"\t"tab\\there"\n"P3"\t"three"\n"P4"\t"quote \\" and \\\\"\n' +
+                b'"P5"\t"five"\n')
+        self.assertRowsInEveryChunking(body, [["P1", "one"], ["P2", "tab\there"], ["P3", "three"],
+                                              ["P4", 'quote " and \\'], ["P5", "five"]])
+
+    def test_language_tags(self):
+        body = HEADER + b'"P1"\t"one"@en\r\n"P2"\t"colour"@en-GB\r\n"P3"\t"drei"@de\t"x"@en\n'
+        self.assertRowsInEveryChunking(body, [["P1", "one"], ["P2", "colour"], ["P3", "drei", "x"]])
+
+    def test_datatypes_and_iris(self):
+        body = (HEADER + b'<http://rdf.biogateway.eu/prot/P1>\t"5"^^<' + XSD.encode() + b'integer>\r\n' +
+                b'<http://rdf.biogateway.eu/prot/P2>\t"0.5"^^<' + XSD.encode() + b'double>\r\n' +
+                b'<http://rdf.biogateway.eu/prot/P3>\t"plain"\r\n')
+        self.assertRowsInEveryChunking(body, [["http://rdf.biogateway.eu/prot/P1", 5],
+                                              ["http://rdf.biogateway.eu/prot/P2", 0.5],
+                                              ["http://rdf.biogateway.eu/prot/P3", "plain"]])
+
+    def test_multibyte_characters(self):
+        body = HEADER + '"P1"\t"café αβ"\n"P2"\t"\U0001F600"@en\n'.encode("utf-8")
+        self.assertRowsInEveryChunking(body, [["P1", "café αβ"], ["P2", "\U0001F600"]])
+
+    def test_unbound_cells_and_bare_numbers(self):
+        body = HEADER + b'"P1"\t\t12\r\n"P2"\t"two"\t\r\n'
+        self.assertRowsInEveryChunking(body, [["P1", "", "12"], ["P2", "two", ""]])
+
+    def test_last_line_without_newline(self):
+        self.assertRowsInEveryChunking(HEADER + b'"P1"\t"one"\r\n"P2"\t"tw\\"o"\r',
+                                       [["P1", "one"], ["P2", 'tw"o']])
+        self.assertRowsInEveryChunking(HEADER + b'"P1"\t"drei"@de', [["P1", "drei"]])
+
+    def test_header_only(self):
+        self.assertRowsInEveryChunking(HEADER, [])
+        self.assertRowsInEveryChunking(b"?uri\t?value", [])
+
+    def test_fast_and_full_paths_agree(self):
+        # An iri anywhere in a chunk sends the whole chunk through parse_tsv_cell; the plain rows of the
+        # chunk come out the same either way.
+        plain = b'"P1"\t"one"@en\n"P2"\t"a\\tb"\n"P3"\t7\n"P4"\t\n'
+        rows = TsvRows()
+        fast = list(rows.feed(HEADER + plain))
+        rows = TsvRows()
+        full = list(rows.feed(HEADER + plain + b"<http://rdf.biogateway.eu/prot/P5>\t\"five\"\n"))
+        self.assertEqual(fast, [["P1", "one"], ["P2", "a\tb"], ["P3", "7"], ["P4", ""]])
+        self.assertEqual(full[:-1], fast)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import unittest
+from types import SimpleNamespace
+
+from pymongo.errors import BulkWriteError
+
+from writer import BulkWriter, merge_update, set_arrays
+
+# BulkWriter in incremental mode against an in-memory collection that applies $set and $addToSet upserts.
+
+
+class FakeCollection:
+    def __init__(self, name):
+        self.name = name
+        self.documents = {}
+
+    def find(self, filter, projection=None):
+        return [self.documents[id] for id in filter["_id"]["$in"] if id in self.documents]
+
+    def bulk_write(self, operations, ordered=True):
+        for operation in operations:
+            document = self.documents.setdefault(operation._filter["_id"], {"_id": operation._filter["_id"]})
+            for operator, fields in operation._doc.items():
+                for field, value in fields.items():
+                    if operator == "$addToSet":
+                        values = document.setdefault(field, [])
+                        values.extend(item for item in value["$each"] if item not in values)
+                    elif "." in field:
+                        head, tail = field.split(".")
+                        document.setdefault(head, {})[tail] = value
+                    else:
+                        document[field] = value
+
+    def insert_many(self, documents, ordered=True):
+        duplicates = [{"code": 11000} for document in documents if document["_id"] in self.documents]
+        for document in documents:
+            self.documents.setdefault(document["_id"], document)
+        if duplicates:
+            raise BulkWriteError({"writeErrors": duplicates})
+
+
+class FakeDatabase(dict):
+    def __missing__(self, name):
+        self[name] = FakeCollection(name)
+        return self[name]
+
+
+def load(db, rows, replace_arrays):
+    # Writes synonym rows of (id, synonym) the way update_synonyms does.
+    writer = BulkWriter(db, 2, "synonyms", incremental=True, replace_arrays=replace_arrays)
+    for id, synonym in rows:
+        writer.update(SimpleNamespace(name="prot"), id, {"$addToSet": {"synonyms": synonym}})
+    writer.flush()
+    return writer
+
+
+class WriterTest(unittest.TestCase):
+    def test_merge_update_keeps_first_occurrences(self):
+        pending = {}
+        merge_update(pending, {"$addToSet": {"synonyms": "a"}, "$set": {"prefLabel": "x"}})
+        merge_update(pending, {"$addToSet": {"synonyms": {"$each": ["b", "a", "c", "b"]}}})
+        self.assertEqual(pending, {"$addToSet": {"synonyms": {"$each": ["a", "b", "c"]}}, "$set": {"prefLabel": "x"}})
+
+    def test_set_arrays(self):
+        update = set_arrays({"$addToSet": {"synonyms": {"$each": ["a", "b"]}}, "$set": {"prefLabel": "x"}})
+        self.assertEqual(update, {"$set": {"prefLabel": "x", "synonyms": ["a", "b"]}})
+
+    def test_removed_values_are_removed(self):
+        db = FakeDatabase()
+        load(db, [("p1", "a"), ("p1", "b"), ("p2", "c"), ("p3", "d")], True)
+        writer = load(db, [("p1", "a"), ("p2", "c"), ("p2", "e"), ("p3", "d")], True)
+        self.assertEqual(db["prot"].documents["p1"]["synonyms"], ["a"])
+        self.assertEqual(db["prot"].documents["p2"]["synonyms"], ["c", "e"])
+        self.assertEqual((writer.written, writer.skipped), (2, 1))
+        self.assertEqual(set(db["prot_seen"].documents), {"p1", "p2", "p3"})
+
+    def test_unchanged_rows_in_another_order_are_skipped(self):
+        db = FakeDatabase()
+        load(db, [("p1", "a"), ("p1", "b")], True)
+        writer = load(db, [("p1", "b"), ("p1", "a")], True)
+        self.assertEqual((writer.written, writer.skipped), (0, 1))
+
+    def test_without_replace_arrays_values_only_grow(self):
+        db = FakeDatabase()
+        load(db, [("p1", "a"), ("p1", "b")], False)
+        load(db, [("p1", "a"), ("p1", "c")], False)
+        self.assertEqual(db["prot"].documents["p1"]["synonyms"], ["a", "b", "c"])
+
+    def test_document_without_rows_keeps_its_values(self):
+        db = FakeDatabase()
+        load(db, [("p1", "a"), ("p2", "b")], True)
+        load(db, [("p2", "b")], True)
+        self.assertEqual(db["prot"].documents["p1"]["synonyms"], ["a"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,26 +1,43 @@
+import os
+import re
+import tempfile
 import time
+from contextlib import ExitStack
 from pymongo import IndexModel, ASCENDING, TEXT, DESCENDING, MongoClient
 from query_generators import *
-import multiprocessing as mp
-import urllib.request
-
-def startBatches(dataType, name, target, context):
-    processes = []
-
-    print(timestamp() + "Counting " + dataType.graph + " " + name + "...")
-    count = target(dataType, context, justCount=True)
+from adaptive import PageSizer, learned_size, retryable
+from cache import open_url
+from coordination import TaskEntry, TaskQueue
+from index_profiles import has_profile, index_profiles, write_prefixes
+from ledger import LedgerEntry, open_ledger
+from metrics import BatchMetrics, export, profiled
+from pipeline import ChunkReader, MeteredStream, StageTimes, report_stages
+from scheduler import BatchError, Job, data_type_key, keyset_paged, multi_valued_fields, sparql_slot, timestamp
+from scores import DegreeTable, table_path
+from writer import BulkWriter, GroupingBuffer, seen_collection, sweep_collection
+
+def startBatches(dataType, name, target, context, count=None, seconds=0.0):
+    # The count and estimated seconds of the field are passed in when the fields have been planned.
+    jobs = []
+
+    if count is None:
+        print(timestamp() + "Counting " + dataType.graph + " " + name + "...")
+        count = target(dataType, context, justCount=True)
     print(timestamp() + "Found " + str(count) + " " + name + " in " + dataType.graph)
-    if count > 0:
-        batches = int(count / context.batch_size) + 1
-        print(timestamp() + "Initializing " + str(batches) + " batches.")
+    batchSize = learned_size(context, data_type_key(dataType) + "/" + name)
+    if count > 0 and keyset_paged(context, name):
+        print(timestamp() + "Adding job: " + dataType.graph + " " + name + " in pages of " + str(batchSize))
+        jobs.append(Job(dataType, name, target, 0, count, estimate=seconds))
+    elif count > 0:
+        batches = int(count / batchSize) + 1
+        print(timestamp() + "Initializing " + str(batches) + " batches of " + str(batchSize) + ".")
         for i in range(batches):
-            offset = i * context.batch_size
-            print(timestamp() + "Adding process: " + dataType.graph + " " + name + " " + str(i + 1) + "/" + str(
+            offset = i * batchSize
+            print(timestamp() + "Adding job: " + dataType.graph + " " + name + " " + str(i + 1) + "/" + str(
                 batches) + " offset: " + str(offset))
-            p = mp.Process(target=target, args=(dataType, context, offset, count))
-            processes.append(p)
+            jobs.append(Job(dataType, name, target, offset, count, size=batchSize, estimate=seconds / batches))
 
-    return processes
+    return jobs
 
 
 indexes_prot_gene = [
@@ -44,9 +61,18 @@ indexes_goall = [
     IndexModel([("fromScore", DESCENDING)]),
     IndexModel([("toScore", DESCENDING)])]
 
+collection_indexes = {
+    "prot": indexes_prot_gene,
+    "gene": indexes_prot_gene,
+    "goall": indexes_goall}
+
+shadow_suffix = "_shadow"
 
-def drop_and_reset_database(dbName):
-    db = MongoClient("mongodb://localhost:27017/")[dbName]
+default_mongo_uri = "mongodb://localhost:27017/"
+
+
+def drop_and_reset_database(dbName, mongoUri=default_mongo_uri):
+    db = MongoClient(mongoUri)[dbName]
 
     db.command("dropDatabase")
     db.prot.create_indexes(indexes_prot_gene)
@@ -58,68 +84,406 @@ def get_ref(db, collection):
     return db[collection.name]
 
 
-def timestamp():
-    return "[" + time.strftime("%H:%M:%S", time.localtime()) + "] "
+def wipe_collections(dbName, names, mongoUri=default_mongo_uri):
+    db = MongoClient(mongoUri)[dbName]
+    for name in names:
+        print(timestamp() + "Wiping collection: " + name)
+        db[name].delete_many({})
 
 
-def get_count(context, query):
-    count_query = generate_count_query(query)
-    url = generateUrl(context.baseUrl, count_query)
-    data = urllib.request.urlopen(url)
-    firstLine = True
-    for line in data:
-        if firstLine:
-            firstLine = False
-            continue
-        count = int(line)
-        return count
+def prepare_shadows(dbName, names, mongoUri=default_mongo_uri):
+    db = MongoClient(mongoUri)[dbName]
+    for name in names:
+        db.drop_collection(name + shadow_suffix)
 
 
-def updater_worker(dataType, context, name, query, handler_function, offset=0, count=0, justCount=False):
+def swap_shadows(dbName, names, mongoUri=default_mongo_uri):
+    # The shadow collections are loaded without indexes. Indexes are built once on the complete data,
+    # and renameCollection with dropTarget replaces the live collection in a single step.
+    db = MongoClient(mongoUri)[dbName]
+    existing = db.list_collection_names()
+    for name in names:
+        shadow = name + shadow_suffix
+        if shadow not in existing:
+            print(timestamp() + "No data was loaded for " + name + ", keeping the current collection.")
+            continue
+        if name in collection_indexes:
+            print(timestamp() + "Building indexes for " + name + "...")
+            db[shadow].create_indexes(collection_indexes[name])
+        # The read side index profile of the live collection, if it has one, is rebuilt on the shadow as well.
+        if name in existing and has_profile(db[name]):
+            print(timestamp() + "Building the index profile of " + name + "...")
+            write_prefixes(db, shadow)
+            db[shadow].create_indexes(index_profiles[name].indexes)
+        db[shadow].rename(name, dropTarget=True)
+        print(timestamp() + "Swapped in rebuilt collection " + name)
+
+
+def reset_seen(dbName, names, mongoUri=default_mongo_uri):
+    db = MongoClient(mongoUri)[dbName]
+    for name in names:
+        db.drop_collection(seen_collection(name))
+
+
+def sweep_removed(dbName, names, mongoUri=default_mongo_uri):
+    db = MongoClient(mongoUri)[dbName]
+    for name in names:
+        print(timestamp() + "Removing documents no longer in the source from " + name + "...")
+        removed = sweep_collection(db, name)
+        print(timestamp() + "Removed " + str(removed) + " documents from " + name)
+
+
+
+XSD = "http://www.w3.org/2001/XMLSchema#"
+integer_types = {XSD + name for name in ["integer", "int", "long", "short", "byte", "nonNegativeInteger",
+                                         "positiveInteger", "negativeInteger", "nonPositiveInteger",
+                                         "unsignedLong", "unsignedInt", "unsignedShort", "unsignedByte"]}
+decimal_types = {XSD + "decimal", XSD + "double", XSD + "float"}
+tsv_escapes = {"t": "\t", "n": "\n", "r": "\r", "b": "\b", "f": "\f", "\"": "\"", "'": "'", "\\": "\\"}
+tsv_escape_pattern = re.compile(r"\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)")
+tsv_language_pattern = re.compile(r'"@[A-Za-z0-9-]+(?=[\t\n])')
+
+
+def unescape_tsv_match(match):
+    escape = match.group(1)
+    if len(escape) > 1:
+        return chr(int(escape[1:], 16))
+    return tsv_escapes.get(escape, escape)
+
+
+def parse_tsv_cell(cell):
+    # Cells follow the SPARQL 1.1 TSV format: "literal"@lang, "literal"^^<datatype>, <iri>, _:bnode or
+    # a bare number. Literals are unescaped and typed numbers converted; bare numbers are kept as text, as
+    # they are by the quote stripping of TsvRows, and unbound cells are returned as "".
+    if not cell:
+        return ""
+    first = cell[0]
+    if first == '"':
+        end = cell.rfind('"')
+        if end == 0:
+            return cell[1:]
+        value = cell[1:end]
+        if "\\" in value:
+            value = tsv_escape_pattern.sub(unescape_tsv_match, value)
+        if end + 1 < len(cell) and cell[end + 1] == "^":
+            datatype = cell[end + 3:].strip("<>")
+            if datatype in integer_types:
+                return int(value)
+            if datatype in decimal_types:
+                return float(value)
+        return value
+    if first == "<" and cell[-1] == ">":
+        return cell[1:-1]
+    return cell
+
+
+class TsvRows:
+    # Splits a SPARQL TSV response fed in arbitrary chunks into one list of cells per result row, skipping
+    # the header. Each chunk is decoded and split in one go; only the trailing partial line is carried over.
+    def __init__(self):
+        self.remainder = b""
+        self.header = True
+
+    def feed(self, chunk):
+        end = chunk.rfind(b"\n") + 1
+        if not end:
+            self.remainder += chunk
+            return
+        text = (self.remainder + chunk[:end] if self.remainder else chunk[:end]).decode("utf-8")
+        self.remainder = chunk[end:]
+        if self.header:
+            self.header = False
+            text = text.partition("\n")[2]
+        if "\r" in text:
+            text = text.replace("\r\n", "\n")
+        # Literals have their quotes, tabs and newlines escaped, so a quote followed by @, a tag and a tab or
+        # newline always closes a tagged literal and the tags of the whole chunk are dropped at once, the
+        # usual English one with a plain replace.
+        if '"@' in text:
+            text = text.replace('"@en\t', '"\t').replace('"@en\n', '"\n')
+            if '"@' in text:
+                text = tsv_language_pattern.sub('"', text)
+        if "^" in text or "<" in text:
+            for line in text.split("\n"):
+                if line:
+                    yield [parse_tsv_cell(cell) for cell in line.split("\t")]
+            return
+        # Without datatypes or iris, the quotes of lines without escapes are only delimiters. They are removed
+        # from each run of such lines at once, and only the lines with a backslash go through parse_tsv_cell.
+        start = 0
+        while start < len(text):
+            escape = text.find("\\", start)
+            end = len(text) if escape < 0 else text.rfind("\n", start, escape) + 1 or start
+            if end > start:
+                for line in text[start:end].replace('"', "").split("\n"):
+                    if line:
+                        yield line.split("\t")
+            if escape < 0:
+                return
+            start = text.find("\n", escape) + 1
+            yield [parse_tsv_cell(cell) for cell in text[end:start - 1].split("\t")]
+
+    def finish(self):
+        if self.remainder.strip() and not self.header:
+            yield [parse_tsv_cell(cell) for cell in self.remainder.decode("utf-8").rstrip("\r").split("\t")]
+        self.remainder = b""
+
+
+def read_tsv_rows(stream, chunk_size=1 << 20):
+    rows = TsvRows()
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        yield from rows.feed(chunk)
+    yield from rows.finish()
+
+
+def get_count(context, query, metrics=None):
+    count_query = generate_count_query(query)
+    url = generateUrl(context.baseUrl, count_query)
+    data = open_results(context, url, metrics)
+    try:
+        rows = list(read_tsv_rows(data))
+    finally:
+        close_results(data, None, metrics)
+    if metrics:
+        metrics.rows = len(rows)
+        metrics.finish()
+        export(context, metrics)
+    if rows:
+        return int(rows[0][0])
+    return 0
+
+
+def updater_worker(dataType, context, name, query, handler_function, offset=0, count=0, justCount=False, after=None,
+                   describe=False):
     startTime = time.time()
+    if describe:
+        return name, query, handler_function
     if justCount:
-        return get_count(context, query)
-    highest = min((offset+context.batch_size), count)
-    mdb = MongoClient("mongodb://localhost:27017/")[context.dbName]
-    start_message = timestamp() + "Downloading " + str(offset) + "-" + str(highest) + " " + name + " data for " + dataType.graph
-    print(start_message)
-    url = generateUrl(context.baseUrl, query, context.batch_size, offset)
-    data = urllib.request.urlopen(url)
-    durationTime = time.time() - startTime
-    print(timestamp() + "Completed download of " + dataType.graph + " " + str(offset) + "-" + str(highest) + " " + name + " data in " + time.strftime("%H:%M:%S.",
-                                                                                    time.gmtime(durationTime)))
-    firstLine = True
-    counter = 0
-    for line in data:
-        if firstLine:
-            firstLine = False
-            continue
-        if counter % 10000 == 0:
-            counterWithOffset = counter + offset
-            progress = str(counterWithOffset)
-            if context.batch_size:
-                progress += "/" + str(highest)
-            print(timestamp() + dataType.graph + " updated " + name + " line " + progress)
-        handler_function(mdb, dataType, line)
-
-        counter += 1
-
+        return get_count(context, query, BatchMetrics(data_type_key(dataType), name + " count", 0))
+    mdb = MongoClient(context.mongo_uri)[context.dbName]
+    # The combined rows and the keyset pages of multi-valued fields hold all values of a document.
+    completeRows = name == "combined" or (name in multi_valued_fields and keyset_paged(context, name))
+    writer = BulkWriter(mdb, context.flush_size, name, context.incremental, shadow_suffix if context.rebuild else "",
+                        context.queue_depth, replace_arrays=completeRows)
+    stages = StageTimes()
+    ledger = open_ledger(context)
+    entry = None
+    if context.task:
+        entry = TaskEntry(TaskQueue(mdb), context.task, context.worker)
+    elif ledger:
+        entry = LedgerEntry(ledger, data_type_key(dataType), name, offset)
+    try:
+        if entry:
+            entry.start(after)
+        with profiled(context, data_type_key(dataType) + " " + name):
+            if keyset_paged(context, name):
+                counter = keyset_pages(dataType, context, name, query, handler_function, writer, stages, count, after,
+                                       entry)
+            else:
+                counter = offset_batch(dataType, context, name, query, handler_function, writer, stages, offset, count)
+            writer.flush()
+        if entry:
+            entry.finish(counter)
+    except Exception as error:
+        if entry:
+            entry.fail(repr(error))
+        raise
+    finally:
+        writer.close()
+        if ledger:
+            ledger.close()
     durationTime = time.time() - startTime
     print(timestamp() + "Updated " +
           str(counter) + " " + dataType.graph + " " + name + " in " + time.strftime("%H:%M:%S.",
                                                                                     time.gmtime(durationTime)))
+    print(timestamp() + "Wrote " + str(writer.written) + " " + dataType.graph + " " + name + " documents at " +
+          str(int(writer.rate())) + " docs/s (" + str(round(writer.writeTime, 1)) + "s in bulk writes)")
+    if context.incremental:
+        print(timestamp() + "Skipped " + str(writer.skipped) + " unchanged " + dataType.graph + " " + name + " documents")
+    report_stages(dataType.graph + " " + name, durationTime, stages, writer)
 
 
-def update_labels(dataType, context, offset=0, count=0, justCount=False):
-    def update_labels_handler(mdb, dataType, line):
-        comps = line.decode("utf-8").replace("\"", "").replace("\n", "").split("\t")
+def open_results(context, url, metrics=None):
+    # The SPARQL slot is held only while the response is downloaded: the stream releases it once the body has
+    # been read, so parsing, handlers and writes do not count against --sparql-connections.
+    startTime = time.time()
+    with ExitStack() as opening:
+        opening.enter_context(sparql_slot())
+        data = open_url(context, url)
+        slot = opening.pop_all()
+    if metrics:
+        metrics.timeToFirstByte = time.time() - startTime
+    if context.queue_depth:
+        return ChunkReader(data, context.queue_depth, slot=slot)
+    return MeteredStream(data, slot)
+
+
+def close_results(data, stages, metrics=None):
+    data.close()
+    if stages:
+        stages.add_reader(data)
+    if metrics:
+        metrics.add_reader(data)
+
+
+def offset_batch(dataType, context, name, query, handler_function, writer, stages, offset, count):
+    # With --adaptive the batch is downloaded in pages whose size follows the endpoint, see adaptive.PageSizer;
+    # otherwise the whole batch is one page.
+    startTime = time.time()
+    highest = min((offset+context.batch_size), count)
+    start_message = timestamp() + "Downloading " + str(offset) + "-" + str(highest) + " " + name + " data for " + dataType.graph
+    print(start_message)
+    metrics = BatchMetrics(data_type_key(dataType), name, offset, writer)
+    writer.metrics = metrics
+    target = writer
+    if name in multi_valued_fields and context.group_buffer:
+        target = GroupingBuffer(writer, context.group_buffer)
+    sizer = PageSizer(context, data_type_key(dataType) + "/" + name)
+    counter = 0
+    attempts = 0
+    position = offset
+    end = offset + context.batch_size
+    while position < end:
+        pageStart = time.time()
+        pageSize = min(sizer.size, end - position)
+        url = generateUrl(context.baseUrl, generate_ordered_query(query), pageSize, position)
+        pageRows = 0
+        try:
+            data = open_results(context, url, metrics)
+            print(timestamp() + "Receiving " + dataType.graph + " " + str(position) + "-" +
+                  str(min(position + pageSize, highest)) + " " + name + " data, first response after " +
+                  str(round(metrics.timeToFirstByte, 1)) + "s")
+            try:
+                for row in read_tsv_rows(data):
+                    if (counter + pageRows) % 10000 == 0:
+                        counterWithOffset = counter + pageRows + offset
+                        progress = str(counterWithOffset)
+                        if context.batch_size:
+                            progress += "/" + str(highest)
+                        print(timestamp() + dataType.graph + " updated " + name + " line " + progress)
+                    handler_function(target, dataType, row)
+
+                    pageRows += 1
+            finally:
+                close_results(data, stages, metrics)
+        except Exception as error:
+            # The rows of the failed page are handed over again by the retry, which is harmless since the
+            # updates are $set and $addToSet upserts.
+            if retryable(error) and attempts < context.retries and sizer.shrink():
+                attempts += 1
+                print(timestamp() + dataType.graph + " " + name + " failed at offset " + str(position) + ": " +
+                      repr(error) + ", retrying with pages of " + str(sizer.size))
+                continue
+            sizer.save()
+            raise
+        attempts = 0
+        sizer.observe(time.time() - pageStart)
+        counter += pageRows
+        position += pageSize
+        if pageRows < pageSize:
+            break
+    sizer.save()
+    if target is not writer:
+        target.flush()
+        if target.spilled:
+            print(timestamp() + "Grouped " + dataType.graph + " " + name + " per document, spilling " +
+                  str(target.spilled) + " documents to disk")
+    writer.flush()
+    durationTime = time.time() - startTime
+    print(timestamp() + "Completed download of " + dataType.graph + " " + str(offset) + "-" + str(highest) + " " + name +
+          " data (" + str(round(metrics.bytes / 1e6, 1)) + " MB) in " + time.strftime("%H:%M:%S.", time.gmtime(durationTime)))
+    metrics.rows = counter
+    metrics.finish(writer)
+    export(context, metrics)
+    return counter
+
+
+def keyset_pages(dataType, context, name, query, handler_function, writer, stages, count, after, entry=None):
+    # Rows of one uri can be split over two pages, so the rows of the last uri on a full page are held back
+    # and the next page starts after the uri before it. The uri of the last completed page is the resume key.
+    # With --adaptive the page size follows the endpoint: see adaptive.PageSizer.
+    sizer = PageSizer(context, data_type_key(dataType) + "/" + name)
+    counter = 0
+    attempts = 0
+    while True:
+        pageStart = time.time()
+        pageSize = sizer.size
+        url = generateUrl(context.baseUrl, generate_keyset_query(query, after, pageSize))
+        metrics = BatchMetrics(data_type_key(dataType), name, after or "", writer)
+        writer.metrics = metrics
+        pageRows = 0
+        pageCounter = 0
+        previousUri = None
+        currentUri = None
+        currentRows = []
+        try:
+            data = open_results(context, url, metrics)
+            try:
+                for row in read_tsv_rows(data):
+                    pageRows += 1
+                    if row[0] != currentUri:
+                        for heldRow in currentRows:
+                            handler_function(writer, dataType, heldRow)
+                        pageCounter += len(currentRows)
+                        previousUri = currentUri
+                        currentUri = row[0]
+                        currentRows = []
+                    currentRows.append(row)
+            finally:
+                close_results(data, stages, metrics)
+            lastPage = pageRows < pageSize
+            if lastPage:
+                for heldRow in currentRows:
+                    handler_function(writer, dataType, heldRow)
+                pageCounter += len(currentRows)
+            elif previousUri is None:
+                if sizer.grow():
+                    print(timestamp() + dataType.graph + " " + name + " has more than " + str(pageSize) +
+                          " rows for one uri, retrying with pages of " + str(sizer.size))
+                    continue
+                raise Exception("A single uri has more than " + str(pageSize) + " rows. Increase --batchsize.")
+            writer.flush()
+        except Exception as error:
+            # The rows already handed to the writer are written again by the retry, which is harmless since
+            # the updates are $set and $addToSet upserts.
+            if retryable(error) and attempts < context.retries and sizer.shrink():
+                attempts += 1
+                print(timestamp() + dataType.graph + " " + name + " page after " + str(after) + " failed: " +
+                      repr(error) + ", retrying with pages of " + str(sizer.size))
+                continue
+            sizer.save()
+            raise BatchError(dataType.graph + " " + name + " failed after " + str(after) + ": " + repr(error), after)
+
+        attempts = 0
+        counter += pageCounter
+        metrics.rows = pageRows
+        metrics.finish(writer)
+        export(context, metrics)
+        durationTime = time.time() - pageStart
+        sizer.observe(durationTime)
+        print(timestamp() + dataType.graph + " updated " + name + " line " + str(counter) + "/" + str(count) +
+              " (page of " + str(pageRows) + " rows in " + str(round(durationTime, 1)) + "s)")
+        if lastPage:
+            sizer.save()
+            return counter
+        after = previousUri
+        if entry:
+            entry.progress(after, counter)
+
+
+def update_labels(dataType, context, offset=0, count=0, justCount=False, after=None, describe=False):
+    def update_labels_handler(writer, dataType, comps):
+        label = str(comps[1])
         for collection in dataType.dbCollections:
             if collection.prefix:
-                definition = collection.prefix + comps[2]
-                update = {"$set": {"prefLabel": comps[1], "lcLabel": comps[1].lower(), "definition": definition}}
+                definition = collection.prefix + str(comps[2])
+                update = {"$set": {"prefLabel": label, "lcLabel": label.lower(), "definition": definition}}
             else:
-                update = {"$set": {"prefLabel": comps[1], "lcLabel": comps[1].lower(), "definition": comps[2]}}
-            response = get_ref(mdb, collection).update_one({"_id": comps[0]}, update, upsert=True)
+                update = {"$set": {"prefLabel": label, "lcLabel": label.lower(), "definition": comps[2]}}
+            writer.update(collection, comps[0], update)
 
     return updater_worker(dataType,
                           context, "labels",
@@ -127,16 +491,17 @@ def update_labels(dataType, context, offset=0, count=0, justCount=False):
                           update_labels_handler,
                           offset,
                           count,
-                          justCount)
+                          justCount,
+                          after,
+                          describe)
 
 
-def update_synonyms(dataType, context, offset=0, count=0, justCount=False):
-    def handler(mdb, dataType, line):
-        comps = line.decode("utf-8").replace("\"", "").replace("\n", "").split("\t")
-        synonym = comps[1]
+def update_synonyms(dataType, context, offset=0, count=0, justCount=False, after=None, describe=False):
+    def handler(writer, dataType, comps):
+        synonym = str(comps[1])
         update = {"$addToSet": {"synonyms": synonym, "lcSynonyms": synonym.lower()}}
         for dbCol in dataType.dbCollections:
-            response = get_ref(mdb, dbCol).update_one({"_id": comps[0]}, update, upsert=True)
+            writer.update(dbCol, comps[0], update)
 
     return updater_worker(dataType,
                           context, "synonyms",
@@ -144,35 +509,117 @@ def update_synonyms(dataType, context, offset=0, count=0, justCount=False):
                           handler,
                           offset,
                           count,
-                          justCount)
-
-
-def update_scores(dataType, context, offset=0, count=0, justCount=False):
-    def handler(mdb, dataType, line):
-        comps = line.decode("utf-8").replace("\"", "").replace("\n", "").split("\t")
-        fromScore = int(comps[1])
-        toScore = int(comps[2])
+                          justCount,
+                          after,
+                          describe)
+
+
+def fetch_uri_rows(context, query):
+    # For queries with one row per uri, every page simply continues after the last uri of the previous one.
+    after = None
+    while True:
+        url = generateUrl(context.baseUrl, generate_keyset_query(query, after, context.batch_size))
+        pageRows = 0
+        data = open_results(context, url)
+        try:
+            for row in read_tsv_rows(data):
+                pageRows += 1
+                after = row[0]
+                yield row
+        finally:
+            close_results(data, None)
+        if not context.batch_size or pageRows < context.batch_size:
+            return
+
+
+def fetch_degrees(context, owners, graph, inbound):
+    # owners maps each scored uri to the tables of the DataTypes that score it; the counts of other uris are
+    # dropped as they arrive.
+    rows = 0
+    for uri, degree in fetch_uri_rows(context, generate_degree_query(graph, inbound)):
+        rows += 1
+        for table in owners.get(uri, ()):
+            if inbound:
+                table.add(uri, inbound=int(degree))
+            else:
+                table.add(uri, outbound=int(degree))
+    return rows
+
+
+def build_degree_tables(context, dataTypes):
+    # Counts the relations of the uris scored by dataTypes once per source graph, instead of once per DataType
+    # over all graphs, and stores a table per DataType for its scores updaters. Returns the path prefix of the
+    # tables. With --cache the tables are reused within --cache-ttl.
+    prefix = os.path.join(context.cache_dir or tempfile.gettempdir(), "degrees-" + context.dbName)
+    tables = {}
+    for dataType in dataTypes:
+        path = table_path(prefix, data_type_key(dataType))
+        if DegreeTable.loaded(path):
+            continue
+        if context.cache_dir and os.path.exists(path) and time.time() - os.path.getmtime(path) < context.cache_ttl * 3600:
+            print(timestamp() + "Using the cached relation counts in " + path)
+            continue
+        tables[data_type_key(dataType)] = (dataType, DegreeTable())
+    if not tables:
+        return prefix
+    startTime = time.time()
+    owners = {}
+    for dataType, table in tables.values():
+        for row in fetch_uri_rows(context, generate_scored_uris_query(dataType.graph, dataType.constraint)):
+            table.add(row[0])
+            owners.setdefault(row[0], []).append(table)
+    data = open_results(context, generateUrl(context.baseUrl, generate_graphs_query()))
+    try:
+        graphs = [row[0] for row in read_tsv_rows(data)]
+    finally:
+        close_results(data, None)
+    for graph in graphs:
+        inbound = fetch_degrees(context, owners, graph, True)
+        outbound = fetch_degrees(context, owners, graph, False)
+        print(timestamp() + "Counted relations of " + graph + ": " + str(inbound) + " objects, " + str(outbound) +
+              " subjects")
+    for key, (dataType, table) in tables.items():
+        table.save(table_path(prefix, key))
+    durationTime = time.time() - startTime
+    print(timestamp() + "Counted the relations of " + str(len(owners)) + " scored uris in " + str(len(graphs)) +
+          " graphs in " + time.strftime("%H:%M:%S.", time.gmtime(durationTime)))
+    return prefix
+
+
+def update_scores(dataType, context, offset=0, count=0, justCount=False, after=None, describe=False):
+    table = None
+
+    def handler(writer, dataType, comps):
+        nonlocal table
+        if table is None:
+            prefix = context.scores_file or build_degree_tables(context, [dataType])
+            table = DegreeTable.load(table_path(prefix, data_type_key(dataType)))
+        fromScore, toScore = table.degrees(comps[0])
+        # Like the former single query, only uris with both inbound and outbound relations are scored.
+        if not fromScore or not toScore:
+            return
         refScore = fromScore + toScore
         update = {"$set": {"refScore": refScore, "toScore": toScore, "fromScore": fromScore}}
         for dbCol in dataType.dbCollections:
-            response = get_ref(mdb, dbCol).update_one({"_id": comps[0]}, update, upsert=True)
+            writer.update(dbCol, comps[0], update)
 
     return updater_worker(dataType,
                           context, "scores",
-                          generate_scores_query(dataType.graph, dataType.constraint),
+                          generate_scored_uris_query(dataType.graph, dataType.constraint),
                           handler,
                           offset,
                           count,
-                          justCount)
+                          justCount,
+                          after,
+                          describe)
 
 
-def update_taxon(dataType, context, offset=0, count=0, justCount=False):
-    def handler(mdb, dataType, line):
-        comps = line.decode("utf-8").replace("\"", "").replace("\n", "").split("\t")
+def update_taxon(dataType, context, offset=0, count=0, justCount=False, after=None, describe=False):
+    def handler(writer, dataType, comps):
         taxon = comps[1]
         update = {"$set": {"taxon": taxon}}
         for dbCol in dataType.dbCollections:
-            response = get_ref(mdb, dbCol).update_one({"_id": comps[0]}, update, upsert=True)
+            writer.update(dbCol, comps[0], update)
 
     query = generate_field_query(dataType.graph, "<http://purl.obolibrary.org/obo/BFO_0000052>",
                                  dataType.constraint)
@@ -182,16 +629,17 @@ def update_taxon(dataType, context, offset=0, count=0, justCount=False):
                           handler,
                           offset,
                           count,
-                          justCount)
+                          justCount,
+                          after,
+                          describe)
 
 
-def update_instances(dataType, context, offset=0, count=0, justCount=False):
-    def handler(mdb, dataType, line):
-        comps = line.decode("utf-8").replace("\"", "").replace("\n", "").split("\t")
+def update_instances(dataType, context, offset=0, count=0, justCount=False, after=None, describe=False):
+    def handler(writer, dataType, comps):
         instance = comps[1]
         update = {"$addToSet": {"instances": instance}}
         for dbCol in dataType.dbCollections:
-            response = get_ref(mdb, dbCol).update_one({"_id": comps[0]}, update, upsert=True)
+            writer.update(dbCol, comps[0], update)
 
     query = generate_field_query(dataType.graph, "<http://schema.org/evidenceOrigin>",
                                  dataType.constraint)
@@ -201,16 +649,17 @@ def update_instances(dataType, context, offset=0, count=0, justCount=False):
                           handler,
                           offset,
                           count,
-                          justCount)
+                          justCount,
+                          after,
+                          describe)
 
 
-def update_annotationScore(dataType, context, offset=0, count=0, justCount=False):
-    def handler(mdb, dataType, line):
-        comps = line.decode("utf-8").replace("\"", "").replace("\n", "").split("\t")
+def update_annotationScore(dataType, context, offset=0, count=0, justCount=False, after=None, describe=False):
+    def handler(writer, dataType, comps):
         score = int(comps[1])
         update = {"$set": {"annotationScore": score}}
         for dbCol in dataType.dbCollections:
-            response = get_ref(mdb, dbCol).update_one({"_id": comps[0]}, update, upsert=True)
+            writer.update(dbCol, comps[0], update)
 
     query = generate_field_query(dataType.graph, "<http://schema.org/evidenceLevel>",
                                  dataType.constraint)
@@ -220,4 +669,62 @@ def update_annotationScore(dataType, context, offset=0, count=0, justCount=False
                           handler,
                           offset,
                           count,
-                          justCount)
+                          justCount,
+                          after,
+                          describe)
+
+
+def combined_fields(dataType):
+    fields = []
+    if dataType.labels:
+        fields.extend(["labels", "synonyms"])
+    if dataType.taxon:
+        fields.append("taxon")
+    if dataType.instances:
+        fields.append("instances")
+    if dataType.annotationScores:
+        fields.append("annotationScore")
+    return fields
+
+
+def update_combined(dataType, context, offset=0, count=0, justCount=False, after=None, describe=False):
+    fields = combined_fields(dataType)
+    columns = []
+    for field in fields:
+        columns.extend(["prefLabel", "definition"] if field == "labels" else [field])
+
+    def handler(writer, dataType, comps):
+        values = dict(zip(columns, comps[1:]))
+        update = {}
+        if "labels" in fields:
+            label = str(values["prefLabel"])
+            update["$set"] = {"prefLabel": label, "lcLabel": label.lower(), "definition": values["definition"]}
+        if values.get("synonyms"):
+            synonyms = str(values["synonyms"]).split(multi_value_separator)
+            update["$addToSet"] = {"synonyms": {"$each": synonyms},
+                                   "lcSynonyms": {"$each": list(dict.fromkeys(synonym.lower() for synonym in synonyms))}}
+        if values.get("taxon"):
+            update.setdefault("$set", {})["taxon"] = values["taxon"]
+        if values.get("instances"):
+            update.setdefault("$addToSet", {})["instances"] = {"$each": str(values["instances"]).split(multi_value_separator)}
+        if values.get("annotationScore", "") != "":
+            update.setdefault("$set", {})["annotationScore"] = int(values["annotationScore"])
+        if not update:
+            return
+        for collection in dataType.dbCollections:
+            if collection.prefix and "labels" in fields:
+                prefixed = dict(update)
+                prefixed["$set"] = dict(update["$set"], definition=collection.prefix + str(values["definition"]))
+                writer.update(collection, comps[0], prefixed)
+            else:
+                writer.update(collection, comps[0], update)
+
+    return updater_worker(dataType,
+                          context, "combined",
+                          generate_combined_query(dataType.graph, dataType.constraint, fields),
+                          handler,
+                          offset,
+                          count,
+                          justCount,
+                          after,
+                          describe)
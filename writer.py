@@ -0,0 +1,284 @@
+import hashlib
+import heapq
+import json
+import pickle
+import queue
+import tempfile
+import threading
+import time
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from scheduler import mongo_slot
+
+DUPLICATE_KEY = 11000
+
+
+def merge_update(pending, update):
+    for operator, fields in update.items():
+        target = pending.setdefault(operator, {})
+        if operator == "$addToSet":
+            for field, value in fields.items():
+                values = target.setdefault(field, {"$each": []})["$each"]
+                known = set(values)
+                for item in value["$each"] if isinstance(value, dict) else [value]:
+                    if item not in known:
+                        known.add(item)
+                        values.append(item)
+        else:
+            target.update(fields)
+
+
+def set_arrays(update):
+    # Turns the $addToSet of an update that holds every value of its document into a $set of whole arrays.
+    arrays = update.pop("$addToSet", None)
+    if arrays:
+        fields = update.setdefault("$set", {})
+        for field, value in arrays.items():
+            fields[field] = value["$each"] if isinstance(value, dict) else [value]
+    return update
+
+
+def fingerprint(update):
+    canonical = {}
+    for operator, fields in update.items():
+        if operator == "$addToSet":
+            canonical[operator] = {field: sorted(map(str, value["$each"])) for field, value in fields.items()}
+        else:
+            canonical[operator] = fields
+    return hashlib.blake2b(json.dumps(canonical, sort_keys=True, default=str).encode("utf-8"),
+                           digest_size=12).hexdigest()
+
+
+def seen_collection(name):
+    return name + "_seen"
+
+
+def sweep_collection(mdb, name, batch_size=1000):
+    # Walks the collection and its seen ids side by side in _id order and deletes every document that was
+    # not written or confirmed during this run.
+    seen = mdb[seen_collection(name)].find({}, {"_id": 1}).sort("_id", 1)
+    nextSeen = next(seen, None)
+    stale = []
+    removed = 0
+    for document in mdb[name].find({}, {"_id": 1}).sort("_id", 1):
+        while nextSeen is not None and nextSeen["_id"] < document["_id"]:
+            nextSeen = next(seen, None)
+        if nextSeen is not None and nextSeen["_id"] == document["_id"]:
+            continue
+        stale.append(document["_id"])
+        if len(stale) >= batch_size:
+            removed += mdb[name].delete_many({"_id": {"$in": stale}}).deleted_count
+            stale = []
+    if stale:
+        removed += mdb[name].delete_many({"_id": {"$in": stale}}).deleted_count
+    mdb.drop_collection(seen_collection(name))
+    return removed
+
+
+class BulkWriter:
+    # Buffers upserts per target collection and flushes them with unordered bulk writes.
+    # Updates to the same _id are merged in the buffer, so every document appears at most once per
+    # flush and the outcome does not depend on the order the server applies the operations in.
+    #
+    # In incremental mode each document keeps a fingerprint per updater under _fp. Updates whose fingerprint
+    # matches the stored one are skipped, and every id is recorded in a <collection>_seen side collection
+    # so documents that are gone from the source can be swept after the run. With replace_arrays the updater
+    # hands over all rows of a document at once, and the arrays of a changed document are replaced with $set,
+    # so values removed from the source are removed from the document too. A document none of whose rows are
+    # left is not written at all, though, and keeps the values it had.
+    #
+    # With a queue_depth the bulk writes run on a writer thread fed through a bounded queue, so the parser
+    # only blocks once that many flushes are waiting. Flushes are written in order by the single thread.
+    def __init__(self, mdb, flush_size, name="", incremental=False, suffix="", queue_depth=0, replace_arrays=False):
+        self.mdb = mdb
+        self.flush_size = flush_size
+        self.suffix = suffix
+        self.fingerprintKey = name.replace(" ", "")
+        self.fingerprintField = "_fp." + self.fingerprintKey
+        self.incremental = incremental
+        self.replace_arrays = replace_arrays
+        self.pending = {}
+        self.written = 0
+        self.skipped = 0
+        self.writeTime = 0.0
+        self.waitTime = 0.0
+        self.error = None
+        self.metrics = None
+        self.background = bool(queue_depth)
+        self.queue = None
+        if queue_depth:
+            self.queue = queue.Queue(queue_depth)
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if not self.error:
+                    self.write(*item)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def check(self):
+        if self.error:
+            error = self.error
+            self.error = None
+            raise error
+
+    def update(self, collection, id, update):
+        # A full buffer is flushed before a new id is added rather than after, so the rows of an id that
+        # arrive together are always written with one operation.
+        name = collection.name + self.suffix
+        pending = self.pending.setdefault(name, {})
+        if id in pending:
+            merge_update(pending[id], update)
+            return
+        if len(pending) >= self.flush_size:
+            self.flush_collection(name)
+            pending = self.pending.setdefault(name, {})
+        pending[id] = {}
+        merge_update(pending[id], update)
+
+    def flush_collection(self, name):
+        pending = self.pending.pop(name, None)
+        if not pending:
+            return
+        if self.queue:
+            self.check()
+            startTime = time.time()
+            self.queue.put((name, pending))
+            self.waitTime += time.time() - startTime
+        else:
+            self.write(name, pending)
+
+    def write(self, name, pending):
+        with mongo_slot():
+            startTime = time.time()
+            if self.incremental:
+                operations = self.changed_operations(name, pending)
+                self.mark_seen(name, pending)
+            else:
+                operations = [UpdateOne({"_id": id}, update, upsert=True) for id, update in pending.items()]
+            if operations:
+                self.mdb[name].bulk_write(operations, ordered=False)
+            duration = time.time() - startTime
+            self.writeTime += duration
+            if self.metrics:
+                self.metrics.add_write(duration)
+        self.written += len(operations)
+        self.skipped += len(pending) - len(operations)
+
+    def changed_operations(self, name, pending):
+        stored = {}
+        for document in self.mdb[name].find({"_id": {"$in": list(pending.keys())}}, {self.fingerprintField: 1}):
+            stored[document["_id"]] = document.get("_fp", {}).get(self.fingerprintKey)
+        operations = []
+        for id, update in pending.items():
+            value = fingerprint(update)
+            if stored.get(id) == value:
+                continue
+            if self.replace_arrays:
+                update = set_arrays(update)
+            update.setdefault("$set", {})[self.fingerprintField] = value
+            operations.append(UpdateOne({"_id": id}, update, upsert=True))
+        return operations
+
+    def mark_seen(self, name, pending):
+        try:
+            self.mdb[seen_collection(name)].insert_many([{"_id": id} for id in pending.keys()], ordered=False)
+        except BulkWriteError as error:
+            if any(writeError["code"] != DUPLICATE_KEY for writeError in error.details["writeErrors"]):
+                raise
+
+    def flush(self):
+        for name in list(self.pending.keys()):
+            self.flush_collection(name)
+        if self.queue:
+            startTime = time.time()
+            self.queue.join()
+            self.waitTime += time.time() - startTime
+            self.check()
+
+    def close(self):
+        if self.queue:
+            self.queue.put(None)
+            self.thread.join()
+            self.queue = None
+
+    def blocked_time(self):
+        # Time the parser spent on writes: waiting for the writer thread, or doing the writes itself.
+        return self.waitTime if self.background else self.writeTime
+
+    def rate(self):
+        if self.writeTime == 0:
+            return 0
+        return self.written / self.writeTime
+
+
+class GroupingBuffer:
+    # Sits between an updater and its BulkWriter and collects all updates of a batch per document, so rows
+    # of the same _id that are far apart in the results still end up in one $addToSet $each. At most
+    # max_documents are held in memory; when it is full they are spilled to a temporary file as a run
+    # sorted by (collection, _id), and flush() merges the runs and hands every document to the writer once.
+    def __init__(self, writer, max_documents):
+        self.writer = writer
+        self.max_documents = max_documents
+        self.collections = {}
+        self.updates = {}
+        self.runs = []
+        self.spilled = 0
+
+    def update(self, collection, id, update):
+        self.collections[collection.name] = collection
+        key = (collection.name, id)
+        if key not in self.updates:
+            if len(self.updates) >= self.max_documents:
+                self.spill()
+            self.updates[key] = {}
+        merge_update(self.updates[key], update)
+
+    def spill(self):
+        run = tempfile.TemporaryFile()
+        for key in sorted(self.updates):
+            pickle.dump((key, self.updates[key]), run, protocol=pickle.HIGHEST_PROTOCOL)
+        run.seek(0)
+        self.runs.append(run)
+        self.spilled += len(self.updates)
+        self.updates = {}
+
+    def flush(self):
+        try:
+            if self.runs:
+                self.spill()
+                entries = heapq.merge(*[read_run(run) for run in self.runs], key=lambda entry: entry[0])
+            else:
+                entries = ((key, self.updates[key]) for key in sorted(self.updates))
+            currentKey = None
+            current = None
+            for key, update in entries:
+                if key != currentKey:
+                    if current is not None:
+                        self.writer.update(self.collections[currentKey[0]], currentKey[1], current)
+                    currentKey = key
+                    current = {}
+                merge_update(current, update)
+            if current is not None:
+                self.writer.update(self.collections[currentKey[0]], currentKey[1], current)
+        finally:
+            for run in self.runs:
+                run.close()
+            self.runs = []
+            self.updates = {}
+
+
+def read_run(run):
+    while True:
+        try:
+            yield pickle.load(run)
+        except EOFError:
+            return